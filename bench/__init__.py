@@ -0,0 +1,10 @@
+#===============================================================================
+# Parser benchmarks
+#
+# grammars.py generates parser-neutral grammars and corpora, parsers.py adapts
+# them to each of the parsers in this repository, and run.py times them (each
+# run in a fresh process, so that memory can be measured too) and writes the
+# results as JSON. Run it with
+#
+#   python -m bench.run -o results.json
+#===============================================================================
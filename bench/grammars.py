@@ -0,0 +1,74 @@
+import random
+
+
+#===============================================================================
+# Synthetic grammars
+#
+# A GrammarSpec is a plain list of (lhs, rhs) productions over names: a name
+# that has productions of its own is a non-terminal, anything else is a word.
+# Every word of the lexicon belongs to `ambiguity` word classes C0, C1, ...,
+# and the recursion type decides the shape of the one recursive rule:
+#
+#   left      X -> X C | C               one tree per class assignment
+#   right     X -> C X | C
+#   center    X -> C X C | C C | C
+#   both      X -> X X | C               every bracketing (Catalan numbers)
+#
+# so a sentence of n words has ambiguity ** n readings (times the Catalan
+# number of n for "both"). Every sequence of words from the lexicon is a
+# sentence, which keeps the corpus generator trivial
+#===============================================================================
+RECURSION_TYPES = ("left", "right", "center", "both")
+
+class GrammarSpec(object):
+    def __init__(self, name, start, productions, words, params):
+        self.name = name
+        self.start = start
+        self.productions = productions     # [(lhs, (term, ...)), ...]
+        self.words = words
+        self.params = params
+    def __repr__(self):
+        return "GrammarSpec(%s)" % (self.name,)
+    def nonterminals(self):
+        names = []
+        for lhs, rhs in self.productions:
+            if lhs not in names:
+                names.append(lhs)
+        return names
+    def productions_of(self, name):
+        return [rhs for lhs, rhs in self.productions if lhs == name]
+    def sentence(self, length, rand = random):
+        return " ".join(rand.choice(self.words) for i in range(length))
+    def corpus(self, length, count, seed = 0):
+        rand = random.Random(seed)
+        return [self.sentence(length, rand) for i in range(count)]
+
+def make_grammar(recursion = "left", ambiguity = 1, lexicon_size = 100):
+    if recursion not in RECURSION_TYPES:
+        raise ValueError("recursion must be one of %s" % (", ".join(RECURSION_TYPES),))
+    if ambiguity < 1:
+        raise ValueError("ambiguity must be at least 1")
+    words = ["w%d" % (i,) for i in range(lexicon_size)]
+    classes = ["C%d" % (i,) for i in range(ambiguity)]
+    productions = []
+    for c in classes:
+        if recursion == "left":
+            productions.append(("X", ("X", c)))
+        elif recursion == "right":
+            productions.append(("X", (c, "X")))
+        elif recursion == "center":
+            productions.append(("X", (c, "X", c)))
+            productions.append(("X", (c, c)))
+        productions.append(("X", (c,)))
+    if recursion == "both":
+        productions.append(("X", ("X", "X")))
+    for c in classes:
+        productions.extend((c, (w,)) for w in words)
+    params = dict(recursion = recursion, ambiguity = ambiguity, lexicon_size = lexicon_size)
+    name = "%s-a%d-l%d" % (recursion, ambiguity, lexicon_size)
+    return GrammarSpec(name, "X", productions, words, params)
+
+def make_grammars(recursion_types = RECURSION_TYPES, ambiguities = (1, 2),
+        lexicon_sizes = (10, 1000)):
+    return [make_grammar(r, a, l) for r in recursion_types for a in ambiguities
+        for l in lexicon_sizes]
@@ -0,0 +1,113 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "tag")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import earley2
+import earley3
+import cyk
+import tig5
+
+
+#===============================================================================
+# Adapters
+#
+# Each parser gets a compile(spec) function, which builds its own grammar
+# objects from a GrammarSpec (and is timed separately), and a parse(grammar,
+# text) function returning (accepted, number of chart states or None).
+# earley2.py prints its charts as it goes; run.py silences stdout, but the
+# printing is still part of its time. earley.py is left out: its parser
+# rejects every input, so its timings would be those of a failing parser.
+# No parser enumerates its trees (tig5 parses with iter_parse, which builds
+# them only when they are consumed), so ambiguity costs what the chart costs
+#===============================================================================
+def _rules(spec, make_rule):
+    rules = dict((name, make_rule(name)) for name in spec.nonterminals())
+    def terms(rhs):
+        return [rules.get(t, t) for t in rhs]
+    return rules, terms
+
+def compile_earley2(spec):
+    rules, terms = _rules(spec, earley2.Rule)
+    for lhs, rhs in spec.productions:
+        rules[lhs].add(earley2.Production(*terms(rhs)))
+    return rules[spec.start]
+
+def parse_earley2(start, text):
+    try:
+        earley2.parse(start, text)
+    except ValueError:
+        return False, None
+    return True, None
+
+def compile_earley3(spec):
+    rules, terms = _rules(spec, earley3.Rule)
+    for lhs, rhs in spec.productions:
+        rules[lhs].add(earley3.Production(*terms(rhs)))
+    return earley3.Grammar(rules[spec.start])
+
+def _parse_earley3(grammar, text, leo):
+    try:
+        state, stats = earley3.parse(grammar, text, leo = leo, stats = True)
+    except ValueError as ex:
+        return False, ex.stats.states
+    return True, stats.states
+
+def parse_earley3(grammar, text):
+    return _parse_earley3(grammar, text, False)
+
+def parse_earley3_leo(grammar, text):
+    return _parse_earley3(grammar, text, True)
+
+def compile_cyk(spec):
+    rules, terms = _rules(spec, earley3.Rule)
+    for lhs, rhs in spec.productions:
+        rules[lhs].add(earley3.Production(*terms(rhs)))
+    return cyk.CNF(rules[spec.start])
+
+def parse_cyk(cnf, text):
+    try:
+        chart, stats = cyk.parse(cnf, text, stats = True)
+    except ValueError as ex:
+        return False, ex.stats.states
+    return True, stats.states
+
+def compile_cyk_pcfg(spec):
+    return cyk.PCFG(compile_cyk(spec))
+
+def parse_cyk_pcfg(pcfg, text):
+    prob, tree = pcfg.viterbi(text.lower().split())
+    return prob > 0, None
+
+def compile_tig5(spec):
+    symbols = dict((name, tig5.NonTerminal(name)) for name in spec.nonterminals())
+    init_trees = [symbols[lhs](*[symbols.get(t, t) for t in rhs])
+        for lhs, rhs in spec.productions]
+    return tig5.TIG(init_trees, []), symbols[spec.start]
+
+def parse_tig5(grammar, text):
+    tig, start = grammar
+    try:
+        trees, stats = tig5.iter_parse(tig, start, text.split(), stats = True)
+    except tig5.ParsingError as ex:
+        return False, ex.stats.states
+    return True, stats.states
+
+PARSERS = [
+    ("earley2", compile_earley2, parse_earley2),
+    ("earley3", compile_earley3, parse_earley3),
+    ("earley3-leo", compile_earley3, parse_earley3_leo),
+    ("cyk", compile_cyk, parse_cyk),
+    ("cyk-pcfg", compile_cyk_pcfg, parse_cyk_pcfg),
+    ("tig5", compile_tig5, parse_tig5),
+]
+PARSER_NAMES = [name for name, _, _ in PARSERS]
+
+def get_parser(name):
+    for name2, compile, parse in PARSERS:
+        if name2 == name:
+            return compile, parse
+    raise ValueError("unknown parser %r (choose from %s)" % (name, ", ".join(PARSER_NAMES)))
@@ -0,0 +1,170 @@
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import resource
+import argparse
+import multiprocessing
+from bench.grammars import make_grammar, RECURSION_TYPES
+from bench.parsers import get_parser, PARSER_NAMES
+
+
+#===============================================================================
+# Runner
+#
+# Every (parser, grammar, sentence length) cell runs in a fresh process: peak
+# RSS is per process, a runaway parser can be killed on a timeout, and no
+# cell warms up the caches of the next one
+#===============================================================================
+def _measure(conn, parser, spec, length, sentences, repeat):
+    sys.stdout = open(os.devnull, "w")
+    try:
+        compile, parse = get_parser(parser)
+        t0 = time.time()
+        grammar = compile(spec)
+        compile_seconds = time.time() - t0
+        corpus = spec.corpus(length, sentences, seed = length)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        best = None
+        for i in range(repeat):
+            gc.collect()
+            accepted = 0
+            states = 0
+            t0 = time.time()
+            for text in corpus:
+                ok, count = parse(grammar, text)
+                accepted += ok
+                states = None if count is None else states + count
+            dt = time.time() - t0
+            best = dt if best is None else min(best, dt)
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.send(dict(compile_seconds = compile_seconds, seconds = best / len(corpus),
+            accepted = accepted, states = states, peak_rss_kb = rss_after,
+            rss_growth_kb = rss_after - rss_before))
+    except Exception as ex:
+        conn.send(dict(error = "%s: %s" % (type(ex).__name__, ex)))
+
+def measure(parser, spec, length, sentences = 5, repeat = 3, timeout = 30):
+    # returns a result record; seconds are per sentence, the best of `repeat`
+    # passes over the corpus
+    record = dict(parser = parser, grammar = spec.name, length = length,
+        sentences = sentences)
+    record.update(spec.params)
+    parent, child = multiprocessing.Pipe(False)
+    proc = multiprocessing.Process(target = _measure,
+        args = (child, parser, spec, length, sentences, repeat))
+    proc.start()
+    if parent.poll(timeout):
+        record.update(parent.recv())
+    else:
+        record["error"] = "timeout after %ss" % (timeout,)
+    proc.terminate()
+    proc.join()
+    return record
+
+def run(parsers = PARSER_NAMES, recursion_types = RECURSION_TYPES, ambiguities = (1, 2),
+        lexicon_sizes = (10, 1000), lengths = (5, 10, 20), sentences = 5, repeat = 3,
+        timeout = 30, report = None):
+    results = []
+    for recursion in recursion_types:
+        for ambiguity in ambiguities:
+            for lexicon_size in lexicon_sizes:
+                spec = make_grammar(recursion, ambiguity, lexicon_size)
+                for parser in parsers:
+                    skip = False
+                    for length in lengths:
+                        if skip:
+                            # a timeout on a shorter sentence will only get worse
+                            record = dict(parser = parser, grammar = spec.name,
+                                length = length, sentences = sentences, error = "skipped")
+                            record.update(spec.params)
+                        else:
+                            record = measure(parser, spec, length, sentences, repeat, timeout)
+                            skip = record.get("error", "").startswith("timeout")
+                        results.append(record)
+                        if report:
+                            report(record)
+    return results
+
+def format_record(record):
+    head = "%-12s %-16s n=%-3d" % (record["parser"], record["grammar"], record["length"])
+    if "error" in record:
+        return "%s  %s" % (head, record["error"])
+    return "%s %10.5fs %9d KB %10s states %3d/%d accepted" % (head, record["seconds"],
+        record["peak_rss_kb"], record["states"] if record["states"] is not None else "-",
+        record["accepted"], record["sentences"])
+
+def _key(record):
+    return (record["parser"], record["grammar"], record["length"])
+
+def compare(old_results, new_results, threshold = 1.25):
+    # returns (old record, new record, ratio) for every cell that got slower
+    # than threshold times, or that used to succeed and no longer does
+    old = dict((_key(r), r) for r in old_results)
+    regressions = []
+    for new in new_results:
+        prev = old.get(_key(new))
+        if prev is None or "error" in prev:
+            continue
+        if "error" in new:
+            regressions.append((prev, new, None))
+        elif new["seconds"] > prev["seconds"] * threshold:
+            regressions.append((prev, new, new["seconds"] / prev["seconds"]))
+    return regressions
+
+def machine_info():
+    return dict(platform = platform.platform(), python = platform.python_version(),
+        cpus = multiprocessing.cpu_count())
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks the parsers of this "
+        "repository on synthetic grammars, and writes the results as JSON")
+    parser.add_argument("-o", "--output", default = "-",
+        help = "JSON output file (default: stdout)")
+    parser.add_argument("--parsers", nargs = "+", default = PARSER_NAMES,
+        choices = PARSER_NAMES)
+    parser.add_argument("--recursion", nargs = "+", default = RECURSION_TYPES,
+        choices = RECURSION_TYPES)
+    parser.add_argument("--ambiguity", nargs = "+", type = int, default = [1, 2])
+    parser.add_argument("--lexicon", nargs = "+", type = int, default = [10, 1000])
+    parser.add_argument("--lengths", nargs = "+", type = int, default = [5, 10, 20])
+    parser.add_argument("--sentences", type = int, default = 5)
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--timeout", type = float, default = 30,
+        help = "seconds allowed per (parser, grammar, length) cell")
+    parser.add_argument("--compare", metavar = "OLD_JSON",
+        help = "report the cells that got slower than in a previous run")
+    parser.add_argument("--threshold", type = float, default = 1.25)
+    args = parser.parse_args(argv)
+
+    def report(record):
+        print >>sys.stderr, format_record(record)
+    results = run(args.parsers, args.recursion, args.ambiguity, args.lexicon, args.lengths,
+        args.sentences, args.repeat, args.timeout, report)
+    doc = dict(machine = machine_info(), time = time.strftime("%Y-%m-%d %H:%M:%S"),
+        results = results)
+    text = json.dumps(doc, indent = 1, sort_keys = True)
+    if args.output == "-":
+        print text
+    else:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)["results"]
+        regressions = compare(old_results, results, args.threshold)
+        for prev, new, ratio in regressions:
+            if ratio is None:
+                print >>sys.stderr, "FAILED  %s (was %.5fs)" % (format_record(new),
+                    prev["seconds"])
+            else:
+                print >>sys.stderr, "%.2fx slower  %s" % (ratio, format_record(new))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
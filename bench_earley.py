@@ -0,0 +1,130 @@
+#===============================================================================
+# Times earley3.parse on the NP/VP/PP grammar with wide lexicons, comparing
+# the indexed completion against the old linear scan of the start column
+#===============================================================================
+import gc
+import time
+import random
+import multiprocessing
+import earley3
+from earley3 import Rule, Production, State
+
+
+def linear_complete(col, state, leo = False, stats = None):
+    if not state.completed():
+        return
+    add = col.add if stats is None else stats.adder(col, "completions")
+    for st in state.start_column:
+        if st.item.next_symbol == state.item.lhs:
+            add(State(st.item.advance, st.start_column, st.inner * state.inner, 
+                st.forward * state.inner))
+
+def make_grammar(lexicon_size):
+    def words(prefix):
+        return ["%s%d" % (prefix, i) for i in range(lexicon_size)]
+    N = Rule("N", *[Production(w) for w in words("n")])
+    V = Rule("V", *[Production(w) for w in words("v")])
+    P = Rule("P", *[Production(w) for w in words("p")])
+    D = Rule("D", *[Production(w) for w in words("d")])
+    PP = Rule("PP")
+    NP = Rule("NP", Production(D, N))
+    NP.add(Production(NP, PP))
+    PP.add(Production(P, NP))
+    VP = Rule("VP", Production(V, NP))
+    VP.add(Production(VP, PP))
+    S = Rule("S", Production(NP, VP), Production(VP))
+    return S
+
+def make_sentence(lexicon_size, num_pps, rand):
+    def w(prefix):
+        return "%s%d" % (prefix, rand.randrange(lexicon_size))
+    tokens = [w("d"), w("n"), w("v"), w("d"), w("n")]
+    for i in range(num_pps):
+        tokens += [w("p"), w("d"), w("n")]
+    return " ".join(tokens)
+
+def timeit(func, *args):
+    t0 = time.time()
+    func(*args)
+    return time.time() - t0
+
+def run(lexicon_size = 10000, num_pps = 3, repeat = 3):
+    rand = random.Random(lexicon_size)
+    S = earley3.Grammar(make_grammar(lexicon_size))
+    sentences = [make_sentence(lexicon_size, num_pps, rand) for i in range(repeat)]
+
+    indexed = sum(timeit(earley3.parse, S, text) for text in sentences)
+    orig_complete = earley3.complete
+    earley3.complete = linear_complete
+    try:
+        linear = sum(timeit(earley3.parse, S, text) for text in sentences)
+    finally:
+        earley3.complete = orig_complete
+    print "lexicon %6d | linear %8.3fs | indexed %8.3fs | speedup %5.1fx" % (
+        lexicon_size, linear, indexed, linear / indexed)
+
+def chart_size(parser):
+    return sum(len(col) for col in parser.table)
+
+def run_leo(length = 1000):
+    # right recursion (R -> a R | a) makes the plain recognizer quadratic
+    R = Rule("R", Production("a"))
+    R.add(Production("a", R))
+    text = " ".join(["a"] * length)
+    for leo in (False, True):
+        gc.collect()
+        t0 = time.time()
+        parser = earley3.IncrementalParser(R, leo)
+        for tok in text.split():
+            parser.feed(tok)
+        parser.finish()
+        print "right recursion, %d tokens, leo=%-5s | %8.3fs | %8d states" % (
+            length, leo, time.time() - t0, chart_size(parser))
+
+def check_leo():
+    # leo must accept and reject exactly the same sentences
+    SYM = Rule("SYM", Production("a"))
+    OP = Rule("OP", Production("+"))
+    EXPR = Rule("EXPR", Production(SYM))
+    EXPR.add(Production(EXPR, OP, EXPR))
+    S = make_grammar(10)
+    rand = random.Random(0)
+    cases = [(EXPR, " + ".join(["a"] * i)) for i in range(1, 15)]
+    cases += [(EXPR, "a + + a"), (EXPR, "a +")]
+    cases += [(S, make_sentence(10, i, rand)) for i in range(6)]
+    cases += [(S, "d1 n1 v1"), (S, "v1 d1 n1 p1")]
+    for rule, text in cases:
+        results = []
+        for leo in (False, True):
+            try:
+                earley3.parse(rule, text, leo = leo)
+            except ValueError:
+                results.append(False)
+            else:
+                results.append(True)
+        assert results[0] == results[1], text
+    print "leo agrees with the plain recognizer on %d sentences" % (len(cases),)
+
+def run_parse_many(lexicon_size = 1000, num_sentences = 400):
+    # throughput of parse_many as the number of worker processes grows
+    rand = random.Random(num_sentences)
+    grammar = earley3.Grammar(make_grammar(lexicon_size))
+    sentences = [make_sentence(lexicon_size, i % 4, rand) for i in range(num_sentences)]
+    workers = 1
+    while workers <= multiprocessing.cpu_count():
+        gc.collect()
+        t0 = time.time()
+        for index, result, error in earley3.parse_many(grammar, sentences, workers):
+            assert error is None, error
+        dt = time.time() - t0
+        print "parse_many, %d workers | %8.3fs | %8.1f sentences/s" % (
+            workers, dt, num_sentences / dt)
+        workers *= 2
+
+
+if __name__ == "__main__":
+    for size in (100, 1000, 10000):
+        run(size)
+    check_leo()
+    run_leo()
+    run_parse_many()
@@ -1,63 +1,732 @@
-class Production(object):
-    def __init__(self, *terms):
-        self.terms = terms
-    def __len__(self):
-        return len(self.terms)
-    def __getitem__(self, index):
-        return self.terms[index]
-    def __iter__(self):
-        return iter(self.terms)
-    def __repr__(self):
-        return " ".join(str(t) for t in self.terms)
-    def __eq__(self, other):
-        if not isinstance(other, Production):
-            return False
-        return self.terms == other.terms
-    def __ne__(self, other):
-        return not (self == other)
-    def __hash__(self):
-        return hash(self.terms)
-
-class Rule(object):
-    def __init__(self, name, *productions):
-        self.name = name
-        self.productions = list(productions)
-    def __str__(self):
-        return self.name
+import itertools
+import numpy
+from earley3 import Rule, Production, ParseStats
+
+
+#===============================================================================
+# Conversion to Chomsky normal form
+#
+# The grammar is rewritten as START, TERM, BIN, DEL and UNIT, in that order.
+# Every production of the result remembers how to map its children back onto
+# the original grammar (spliced helper symbols, dropped nullable symbols and
+# eliminated unit rules), so trees come out in terms of the original rules
+#===============================================================================
+class CNFProduction(object):
+    def __init__(self, lhs, rhs, prob, shape, chain = (), label = None):
+        self.lhs = lhs
+        # the symbol whose node shape describes; differs from lhs after UNIT
+        self.label = lhs if label is None else label
+        self.rhs = rhs       # symbol ids (non-terminals) and strings (terminals)
+        self.prob = prob
+        # what the children of the lhs node are, in terms of the original
+        # grammar: an int is an index into rhs, a tuple (symbol,) stands for
+        # a nullable symbol that was dropped
+        self.shape = shape
+        # the unit productions that were eliminated on the way to this one,
+        # outermost first
+        self.chain = chain
+    def is_unit(self):
+        return len(self.rhs) == 1 and not isinstance(self.rhs[0], basestring)
+
+class CNF(object):
+    START_NAME = u"S0"
+
+    def __init__(self, start):
+        self.names = []        # symbol id -> name
+        self.internal = []     # symbol id -> whether it was made up by the conversion
+        self.productions = []  # symbol id -> list of CNFProductions
+        ids = {}
+        rules = []
+        pending = [start]
+        while pending:
+            rule = pending.pop(0)
+            if rule.name in ids:
+                continue
+            ids[rule.name] = self._new_symbol(rule.name)
+            rules.append(rule)
+            for prod in rule.productions:
+                pending.extend(t for t in prod if isinstance(t, Rule))
+        for rule in rules:
+            for prod in rule.productions:
+                rhs = tuple(ids[t.name] if isinstance(t, Rule) else t for t in prod)
+                self._add(CNFProduction(ids[rule.name], rhs, prod.prob, tuple(range(len(rhs)))))
+
+        # START: a fresh start symbol, which never appears on a right-hand side
+        self.start = self._new_symbol(self.START_NAME, internal = True)
+        self._add(CNFProduction(self.start, (ids[start.name],), 1.0, (0,)))
+        self._term()
+        self._bin()
+        self._del()
+        self._unit()
+        self._index()
+
+    def _new_symbol(self, name, internal = False):
+        self.names.append(name)
+        self.internal.append(internal)
+        self.productions.append([])
+        return len(self.names) - 1
+
+    def _add(self, prod):
+        self.productions[prod.lhs].append(prod)
+
+    def _all_productions(self):
+        return [prod for prods in self.productions for prod in prods]
+
+    def _term(self):
+        # TERM: terminals only appear in productions of the form A -> a
+        term_symbols = {}
+        for prod in self._all_productions():
+            if len(prod.rhs) < 2:
+                continue
+            rhs = list(prod.rhs)
+            for i, t in enumerate(rhs):
+                if isinstance(t, basestring):
+                    if t not in term_symbols:
+                        sym = term_symbols[t] = self._new_symbol(u"<%s>" % (t,), internal = True)
+                        self._add(CNFProduction(sym, (t,), 1.0, (0,)))
+                    rhs[i] = term_symbols[t]
+            prod.rhs = tuple(rhs)
+        self.terminal_symbols = set(term_symbols.values())
+
+    def _bin(self):
+        # BIN: split A -> X1 X2 ... Xn into A -> X1 A1, A1 -> X2 A2, ...
+        for prod in self._all_productions():
+            if len(prod.rhs) <= 2:
+                continue
+            rhs = prod.rhs
+            rest = self._new_symbol(u"%s|%d" % (self.names[prod.lhs], len(self.names)),
+                internal = True)
+            self.productions[prod.lhs].remove(prod)
+            self._add(CNFProduction(prod.lhs, (rhs[0], rest), prod.prob, prod.shape[:2]))
+            for i in range(1, len(rhs) - 2):
+                sym = self._new_symbol(u"%s|%d" % (self.names[prod.lhs], len(self.names)),
+                    internal = True)
+                self._add(CNFProduction(rest, (rhs[i], sym), 1.0, (0, 1)))
+                rest = sym
+            self._add(CNFProduction(rest, rhs[-2:], 1.0, (0, 1)))
+
+    def _del(self):
+        # DEL: drop epsilon productions, adding every variant of the productions
+        # that omits nullable symbols. Variants are weighted by the probability
+        # that the omitted symbols derive the empty string
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for prod in self._all_productions():
+                if prod.lhs not in nullable and all(t in nullable for t in prod.rhs):
+                    nullable.add(prod.lhs)
+                    changed = True
+        # the productions that can derive the empty string, for rebuilding the
+        # subtrees of dropped symbols
+        self.empty_productions = [[prod for prod in prods if all(t in nullable for t in prod.rhs)]
+            for prods in self.productions]
+        self._empty = {}
+
+        null_prob = [0.0] * len(self.names)
+        for i in range(len(self.names) + 1):
+            changed = False
+            for sym in range(len(self.names)):
+                p = sum(self._null_prob_of(prod, null_prob) for prod in self.productions[sym])
+                if p != null_prob[sym]:
+                    null_prob[sym] = p
+                    changed = True
+            if not changed:
+                break
+        self.null_prob = null_prob
+
+        for sym in range(len(self.names)):
+            prods = []
+            for prod in self.productions[sym]:
+                for keep in self._subsets(prod.rhs, nullable):
+                    if not keep and sym != self.start:
+                        continue
+                    prob = prod.prob
+                    index = {}
+                    for i, t in enumerate(prod.rhs):
+                        if i in keep:
+                            index[i] = len(index)
+                        else:
+                            prob *= null_prob[t]
+                    shape = tuple(index[i] if i in index else (prod.rhs[i],)
+                        for i in prod.shape)
+                    prods.append(CNFProduction(sym, tuple(prod.rhs[i] for i in keep),
+                        prob, shape))
+            self.productions[sym] = prods
+
+    @staticmethod
+    def _null_prob_of(prod, null_prob):
+        p = prod.prob
+        for t in prod.rhs:
+            p *= 0.0 if isinstance(t, basestring) else null_prob[t]
+        return p
+
+    @staticmethod
+    def _subsets(rhs, nullable):
+        # the index sets of rhs to keep, where only nullable symbols may be dropped
+        subsets = [()]
+        for i, t in enumerate(rhs):
+            subsets = [s + (i,) for s in subsets] + (
+                subsets if not isinstance(t, basestring) and t in nullable else [])
+        return subsets
+
+    def _unit(self):
+        # UNIT: replace A -> B by A -> w for every non-unit B -> w. The unit
+        # productions are kept aside, for the outside pass of PCFG. A -> A
+        # (which DEL makes of A -> A B, when B is nullable) derives nothing
+        # new, and is dropped; unit_loops keeps the probability of the loops
+        # of each symbol, for PCFG and Chart.count
+        self.unit_loops = {}
+        for sym in range(len(self.names)):
+            prods = []
+            for prod in self.productions[sym]:
+                if prod.is_unit() and prod.rhs[0] == sym:
+                    self.unit_loops[sym] = self.unit_loops.get(sym, 0.0) + prod.prob
+                else:
+                    prods.append(prod)
+            self.productions[sym] = prods
+        self.unit_productions = [prod for prod in self._all_productions() if prod.is_unit()]
+        closure = {}
+        def expand(sym, path):
+            if sym in path:
+                raise ValueError("unit cycle through %s" % (self.names[sym],))
+            if sym not in closure:
+                prods = []
+                for prod in self.productions[sym]:
+                    if not prod.is_unit():
+                        prods.append(prod)
+                        continue
+                    for prod2 in expand(prod.rhs[0], path + (sym,)):
+                        prods.append(CNFProduction(sym, prod2.rhs, prod.prob * prod2.prob,
+                            prod2.shape, (prod,) + prod2.chain, prod2.label))
+                closure[sym] = prods
+            return closure[sym]
+        for sym in range(len(self.names)):
+            expand(sym, ())
+        self.productions = [closure[sym] for sym in range(len(self.names))]
+
+    @staticmethod
+    def chain_symbols(prod):
+        # the symbols of the nodes prod stands for: its lhs, and those of the
+        # eliminated unit productions, outermost first
+        return (prod.lhs,) + tuple(unit.rhs[0] for unit in prod.chain)
+
+    def empty(self, sym):
+        # every way sym derives the empty string, as a list of alternatives,
+        # each the list of nodes that stand for sym
+        if sym not in self._empty:
+            self._empty[sym] = None
+            self._empty[sym] = [alt for prod in self.empty_productions[sym]
+                for alt in self.build(prod, [self.empty(t) for t in prod.rhs])]
+        elif self._empty[sym] is None:
+            raise ValueError("infinitely many empty derivations of %s" % (self.names[sym],))
+        return self._empty[sym]
+
+    def build(self, prod, kids):
+        # maps a CNF production back onto the original grammar. kids holds the
+        # alternatives for each child in prod.rhs; returns the alternatives
+        # for the lhs, each a list of nodes (several for a helper symbol, and
+        # a terminal string for a TERM symbol)
+        alts = self._shape(prod, kids)
+        for unit in reversed(prod.chain):
+            alts = self._shape(unit, [alts])
+        return alts
+
+    def _shape(self, prod, kids):
+        parts = [self.empty(s[0]) if isinstance(s, tuple) else kids[s] for s in prod.shape]
+        alts = []
+        for combination in itertools.product(*parts):
+            children = [node for part in combination for node in part]
+            if not self.internal[prod.label]:
+                alts.append([Tree(self.names[prod.label], children)])
+            elif prod.label in self.terminal_symbols:
+                alts.append([prod.rhs[0]])
+            else:
+                alts.append(children)
+        return alts
+
+    def multiplicity(self, prod):
+        # the number of ways the dropped symbols of prod derive the empty string
+        n = 1
+        for p in (prod,) + prod.chain:
+            for s in p.shape:
+                if isinstance(s, tuple):
+                    n *= len(self.empty(s[0]))
+        return n
+
+    def _index(self):
+        # lexical: terminal -> bitset of the symbols that derive it
+        # binary_by_left: B -> [(bit of C, bitset of A)] for all A -> B C
+        self.lexical = {}
+        self.lexical_prods = {}
+        self.binary_by_left = [[] for sym in self.names]
+        by_pair = {}
+        self.binary = []
+        for prod in self._all_productions():
+            if len(prod.rhs) == 1:
+                t = prod.rhs[0]
+                self.lexical[t] = self.lexical.get(t, 0) | (1 << prod.lhs)
+                self.lexical_prods.setdefault((t, prod.lhs), []).append(prod)
+            elif len(prod.rhs) == 2:
+                b, c = prod.rhs
+                by_pair[b, c] = by_pair.get((b, c), 0) | (1 << prod.lhs)
+                self.binary.append(prod)
+        for (b, c), amask in by_pair.items():
+            self.binary_by_left[b].append((1 << c, amask))
+        self.right_mask = [0] * len(self.names)
+        for b, pairs in enumerate(self.binary_by_left):
+            for cbit, _ in pairs:
+                self.right_mask[b] |= cbit
+        self.accepts_empty = any(not prod.rhs for prod in self.productions[self.start])
+
     def __repr__(self):
-        return "%s -> %s" % (self.name, " | ".join(repr(p) for p in self.productions))
-    def add(self, *productions):
-        self.productions.extend(productions)
+        def sym(t):
+            return repr(t) if isinstance(t, basestring) else self.names[t]
+        return "\n".join("%s -> %s" % (self.names[prod.lhs], " ".join(sym(t) for t in prod.rhs))
+            for prod in self._all_productions())
+
+#===============================================================================
+# CYK
+#
+# Each chart cell is an int used as a bitset over the non-terminals, so all
+# rules with the same left child are combined with a single AND per split
+# point; trees are only built (lazily) when asked for
+#===============================================================================
+class Tree(object):
+    def __init__(self, label, children):
+        self.label = label
+        self.children = children
+    def print_(self, level = 0):
+        print "  " * level + str(self.label)
+        for child in self.children:
+            if isinstance(child, Tree):
+                child.print_(level + 1)
+            else:
+                print "  " * (level + 1) + child
+    def bracketed(self):
+        return "(%s %s)" % (self.label, " ".join(c.bracketed() if isinstance(c, Tree) else c
+            for c in self.children))
+
+def _bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+class Chart(object):
+    def __init__(self, cnf, tokens, stats = None):
+        self.cnf = cnf
+        self.tokens = tokens
+        n = len(tokens)
+        # cells[i][j] is the bitset of the symbols deriving tokens[i:j]
+        self.cells = [[0] * (n + 1) for i in range(n + 1)]
+        for i, tok in enumerate(tokens):
+            self.cells[i][i + 1] = cnf.lexical.get(tok, 0)
+        by_left = cnf.binary_by_left
+        right_mask = cnf.right_mask
+        for length in range(2, n + 1):
+            for i in range(n - length + 1):
+                j = i + length
+                mask = 0
+                for k in range(i + 1, j):
+                    left = self.cells[i][k]
+                    right = self.cells[k][j]
+                    if not left or not right:
+                        continue
+                    for b in _bits(left):
+                        if not right & right_mask[b]:
+                            continue
+                        for cbit, amask in by_left[b]:
+                            if right & cbit:
+                                mask |= amask
+                self.cells[i][j] = mask
+        self._counts = {}
+        if stats is not None:
+            self._collect(stats)
 
-grammar = 
+    def _collect(self, stats):
+        # replays the combinations of the filled chart to count them, so
+        # the loop above stays as tight as it is. Lexical entries count as
+        # scans and binary combinations as completions; CYK never predicts
+        n = len(self.tokens)
+        names = self.cnf.names
+        for i in range(n):
+            for a in _bits(self.cells[i][i + 1]):
+                stats.count("scans", names[a])
+                stats.states += 1
+        for length in range(2, n + 1):
+            for i in range(n - length + 1):
+                j = i + length
+                mask = 0
+                for k in range(i + 1, j):
+                    left = self.cells[i][k]
+                    right = self.cells[k][j]
+                    for b in _bits(left):
+                        for cbit, amask in self.cnf.binary_by_left[b]:
+                            if right & cbit:
+                                for a in _bits(amask):
+                                    stats.count("completions", names[a])
+                                    stats.states += 1
+                                stats.duplicates += bin(amask & mask).count("1")
+                                mask |= amask
+        for j in range(n + 1):
+            stats.column_sizes.append(sum(bin(self.cells[i][j]).count("1") for i in range(j)))
+        stats.update_memory()
 
+    def accepts(self):
+        if not self.tokens:
+            return self.cnf.accepts_empty
+        return bool(self.cells[0][len(self.tokens)] >> self.cnf.start & 1)
 
-def cfg_to_cnf(start):
-    S0 = Rule("S0", Production(start))
-    
+    def _empty_productions(self):
+        return [prod for prod in self.cnf.productions[self.cnf.start] if not prod.rhs]
 
+    def _derivations(self, sym, i, j):
+        # yields (production, [(child symbol, start, end)]) for sym over [i, j)
+        if j == i + 1:
+            for prod in self.cnf.lexical_prods.get((self.tokens[i], sym), ()):
+                yield prod, ()
+            return
+        for prod in self.cnf.productions[sym]:
+            if len(prod.rhs) != 2:
+                continue
+            b, c = prod.rhs
+            for k in range(i + 1, j):
+                if self.cells[i][k] >> b & 1 and self.cells[k][j] >> c & 1:
+                    yield prod, ((b, i, k), (c, k, j))
+
+    def count(self, sym = None, i = 0, j = None):
+        if sym is None:
+            if not self.tokens:
+                return sum(self.cnf.multiplicity(prod) for prod in self._empty_productions())
+            sym, j = self.cnf.start, len(self.tokens)
+        key = (sym, i, j)
+        if key not in self._counts:
+            total = 0
+            for prod, children in self._derivations(sym, i, j):
+                for s in self.cnf.chain_symbols(prod):
+                    if s in self.cnf.unit_loops:
+                        raise ValueError("infinitely many derivations through the unit loop of %s"
+                            % (self.cnf.names[s],))
+                n = self.cnf.multiplicity(prod)
+                for child in children:
+                    n *= self.count(*child)
+                total += n
+            self._counts[key] = total
+        return self._counts[key]
+
+    def _trees(self, sym, i, j):
+        # lazily yields the nodes standing for sym over [i, j)
+        for prod, children in self._derivations(sym, i, j):
+            if not children:
+                for alt in self.cnf.build(prod, [[[prod.rhs[0]]]]):
+                    yield alt
+                continue
+            for left in self._trees(*children[0]):
+                for right in self._trees(*children[1]):
+                    for alt in self.cnf.build(prod, [[left], [right]]):
+                        yield alt
+
+    def __iter__(self):
+        if not self.tokens:
+            if self.cnf.accepts_empty:
+                for prod in self._empty_productions():
+                    for alt in self.cnf.build(prod, []):
+                        yield alt[0]
+            return
+        for nodes in self._trees(self.cnf.start, 0, len(self.tokens)):
+            yield nodes[0]
 
+def parse(rule, text, stats = None):
+    # pass a CNF to avoid converting the grammar on every call. With stats
+    # (True or an earley3.ParseStats), returns (chart, stats)
+    cnf = rule if isinstance(rule, CNF) else CNF(rule)
+    stats = ParseStats() if stats is True else (stats or None)
+    chart = Chart(cnf, text.lower().split(), stats)
+    if not chart.accepts():
+        ex = ValueError("parsing failed")
+        ex.stats = stats
+        raise ex
+    if stats is None:
+        return chart
+    return chart, stats
 
 
+#===============================================================================
+# Probabilistic CYK
+#
+# The inside, outside and Viterbi passes run a whole span length at a time on
+# arrays. For every (B, C) pair that occurs in the grammar, the split points of
+# all spans are combined at once (an einsum for inside, a max for Viterbi);
+# the binary rules then act as parallel arrays (parent, pair, probability)
+# sorted by parent, so each cell is a segmented sum/max over them. This is a
+# dense (A, B, C) tensor without its zeros, which dominate once TERM and BIN
+# have added their helper symbols
+#===============================================================================
+class PCFG(object):
+    def __init__(self, rule):
+        cnf = self.cnf = rule if isinstance(rule, CNF) else CNF(rule)
+        self.size = len(cnf.names)
+        # the unit loops that UNIT dropped may be taken any number of times by
+        # each node, which multiplies the sum of the probabilities of its
+        # derivations by 1 / (1 - p) (the best derivation takes none)
+        loop_factor = numpy.ones(self.size)
+        for sym, p in cnf.unit_loops.items():
+            if p >= 1.0:
+                raise ValueError("the unit loop of %s has probability 1" % (cnf.names[sym],))
+            loop_factor[sym] = 1.0 / (1.0 - p)
+        # (a, b, c) -> [sum of probabilities, best probability, best production]
+        rules = {}
+        lexical = {}
+        for prod in cnf._all_productions():
+            if len(prod.rhs) == 2:
+                key = (prod.lhs,) + prod.rhs
+                table = rules
+            elif len(prod.rhs) == 1:
+                key = (prod.rhs[0], prod.lhs)
+                table = lexical
+            else:
+                continue
+            entry = table.setdefault(key, [0.0, -1.0, None])
+            entry[0] += prod.prob * loop_factor[list(cnf.chain_symbols(prod))].prod()
+            if prod.prob > entry[1]:
+                entry[1:] = [prod.prob, prod]
 
+        pairs = sorted(set((b, c) for a, b, c in rules))
+        pair_index = dict((pair, p) for p, pair in enumerate(pairs))
+        self.left = numpy.array([b for b, c in pairs], dtype = int)
+        self.right = numpy.array([c for b, c in pairs], dtype = int)
+        # the rules sorted by parent, for segmented max/sum over each parent
+        keys = sorted(rules)
+        self.rule_parent = numpy.array([a for a, b, c in keys], dtype = int)
+        self.rule_pair = numpy.array([pair_index[b, c] for a, b, c in keys], dtype = int)
+        self.rule_prob = numpy.array([rules[k][0] for k in keys])
+        self.rule_max = numpy.array([rules[k][1] for k in keys])
+        self.rule_prods = [rules[k][2] for k in keys]
+        _, self.rule_groups, self.group_parent = self._groups(self.rule_parent)
+        # the rules sorted by pair, and the pairs sorted by left/right child,
+        # for the outside pass
+        self._by_pair = self._groups(self.rule_pair)
+        self._by_left = (None,) + self._groups(self.left)[1:]   # already sorted
+        self._by_right = self._groups(self.right)
 
+        self.lexical = {}
+        for (t, a), (prob, best, prod) in lexical.items():
+            if t not in self.lexical:
+                self.lexical[t] = (numpy.zeros(self.size), numpy.zeros(self.size), {})
+            self.lexical[t][0][a] = prob
+            self.lexical[t][1][a] = best
+            self.lexical[t][2][a] = prod
+        self.empty_prob = sum(prod.prob for prod in cnf.productions[cnf.start] if not prod.rhs)
 
+        # unit_closure[a, b] is the probability that a derives b through one
+        # or more unit productions, loops included (there are no other unit 
+        # cycles, so the powers of the unit matrix run out)
+        units = numpy.zeros((self.size, self.size))
+        for prod in cnf.unit_productions:
+            units[prod.lhs, prod.rhs[0]] += prod.prob * loop_factor[prod.lhs]
+        self.unit_closure = numpy.zeros((self.size, self.size))
+        power = units
+        while power.any():
+            self.unit_closure += power
+            power = numpy.dot(power, units)
 
+    @staticmethod
+    def _groups(symbols):
+        order = numpy.argsort(symbols, kind = "mergesort")
+        sorted_symbols = symbols[order]
+        starts = numpy.flatnonzero(numpy.r_[True, sorted_symbols[1:] != sorted_symbols[:-1]]) \
+            if len(symbols) else numpy.zeros(0, dtype = int)
+        return order, starts, sorted_symbols[starts]
 
+    def _lexical(self, tokens, which):
+        cells = numpy.zeros((len(tokens), self.size))
+        for i, tok in enumerate(tokens):
+            if tok in self.lexical:
+                cells[i] = self.lexical[tok][which]
+        return cells
 
+    @staticmethod
+    def _spans(n, length):
+        # starts of the spans of the given length, and their split offsets
+        starts = numpy.arange(n - length + 1)[:, None]
+        offsets = numpy.arange(1, length)[None, :]
+        return starts, offsets
 
+    def _children(self, chart, n, length):
+        # chart entries of the left and right children of every (B, C) pair,
+        # for every split point of every span of the given length
+        starts, offsets = self._spans(n, length)
+        left = chart[starts, starts + offsets][:, :, self.left]
+        right = chart[starts + offsets, starts + length][:, :, self.right]
+        return starts[:, 0], left, right
 
+    def inside(self, tokens):
+        # chart[i, j, a] is the probability that a derives tokens[i:j]
+        n = len(tokens)
+        chart = numpy.zeros((n + 1, n + 1, self.size))
+        index = numpy.arange(n)
+        chart[index, index + 1] = self._lexical(tokens, 0)
+        for length in range(2, n + 1):
+            if not len(self.rule_pair):
+                break
+            starts, left, right = self._children(chart, n, length)
+            pairs = numpy.einsum("skp,skp->sp", left, right)
+            chart[starts[:, None], starts[:, None] + length, self.group_parent] = \
+                numpy.add.reduceat(pairs[:, self.rule_pair] * self.rule_prob, self.rule_groups,
+                    axis = 1)
+        return chart
 
+    def outside(self, tokens, inside = None):
+        # chart[i, j, a] is the probability of deriving tokens[:i] a tokens[j:].
+        # The pass itself runs over the converted grammar, in which a symbol
+        # that unit productions derive (like S in S0 -> S) is only ever a child
+        # of a binary rule; the contexts of the symbols above it in the unit
+        # chains are added at the end
+        n = len(tokens)
+        if inside is None:
+            inside = self.inside(tokens)
+        chart = numpy.zeros((n + 1, n + 1, self.size))
+        chart[0, n, self.cnf.start] = 1.0
+        for length in range(n, 1, -1):
+            if not len(self.rule_pair):
+                break
+            starts, offsets = self._spans(n, length)
+            parents = chart[starts, starts + length][:, 0, self.rule_parent] * self.rule_prob
+            weights = self._scatter(parents, self._by_pair, len(self.left))[:, None, :]
+            right = inside[starts + offsets, starts + length][:, :, self.right]
+            # (the gathered children are copies, and are weighted in place)
+            chart[starts, starts + offsets] += self._scatter(
+                numpy.multiply(right, weights, out = right), self._by_left, self.size)
+            # gathered straight in right-child order, to save reordering the products
+            order, groups, bins = self._by_right
+            left = inside[starts, starts + offsets][:, :, self.left[order]]
+            chart[starts + offsets, starts + length] += self._scatter(
+                numpy.multiply(left, weights[:, :, order], out = left), (None, groups, bins),
+                self.size)
+        return chart + numpy.dot(chart, self.unit_closure)
 
+    @staticmethod
+    def _scatter(values, groups, size):
+        # sums the last axis of values into size bins, as grouped by _groups
+        # (order is None when values are already sorted)
+        order, starts, bins = groups
+        if order is not None:
+            values = values[..., order]
+        out = numpy.zeros(values.shape[:-1] + (size,))
+        out[..., bins] = numpy.add.reduceat(values, starts, axis = -1)
+        return out
 
+    def marginals(self, tokens):
+        # chart[i, j, a] is the posterior probability of a spanning tokens[i:j],
+        # for i < j (symbols that DEL dropped, which span no tokens, aren't
+        # counted); the symbols that TERM and BIN made up have entries too
+        inside = self.inside(tokens)
+        total = inside[0, len(tokens), self.cnf.start] if tokens else self.empty_prob
+        if not total:
+            raise ValueError("parsing failed")
+        return self.outside(tokens, inside) * inside / total
 
+    def viterbi(self, tokens):
+        # returns (probability, tree) of the most probable parse. Only the best
+        # scores are kept on the chart; the tree is recovered from them
+        n = len(tokens)
+        if not tokens:
+            empty = [prod for prod in self.cnf.productions[self.cnf.start] if not prod.rhs]
+            if not empty:
+                return 0.0, None
+            best = max(empty, key = lambda prod: prod.prob)
+            return best.prob, self.cnf.build(best, [])[0][0]
+        chart = numpy.zeros((n + 1, n + 1, self.size))
+        index = numpy.arange(n)
+        chart[index, index + 1] = self._lexical(tokens, 1)
+        for length in range(2, n + 1):
+            if not len(self.rule_pair):
+                break
+            starts, left, right = self._children(chart, n, length)
+            pairs = numpy.multiply(left, right, out = left).max(axis = 1)
+            chart[starts[:, None], starts[:, None] + length, self.group_parent] = \
+                numpy.maximum.reduceat(pairs[:, self.rule_pair] * self.rule_max,
+                    self.rule_groups, axis = 1)
+        prob = chart[0, n, self.cnf.start]
+        if not prob:
+            return 0.0, None
+        return prob, self._best_tree(tokens, chart, self.cnf.start, 0, n)[0]
 
+    def _best_tree(self, tokens, chart, sym, i, j):
+        # nodes standing for sym over [i, j), following the rule and split
+        # point that reach its score; dropped nullable symbols get their first
+        # empty derivation
+        if j == i + 1:
+            prod = self.lexical[tokens[i]][2][sym]
+            return self.cnf.build(prod, [[[tokens[i]]]])[0]
+        group = numpy.searchsorted(self.group_parent, sym)
+        first = self.rule_groups[group]
+        last = self.rule_groups[group + 1] if group + 1 < len(self.rule_groups) \
+            else len(self.rule_pair)
+        pairs = self.rule_pair[first:last]
+        mids = numpy.arange(i + 1, j)[:, None]
+        scores = chart[i, mids, self.left[pairs]] * chart[mids, j, self.right[pairs]] * \
+            self.rule_max[first:last]
+        split, r = numpy.unravel_index(scores.argmax(), scores.shape)
+        k = i + 1 + split
+        prod = self.rule_prods[first + r]
+        left = self._best_tree(tokens, chart, self.left[pairs[r]], i, k)
+        right = self._best_tree(tokens, chart, self.right[pairs[r]], k, j)
+        return self.cnf.build(prod, [[left], [right]])[0]
 
+def parse_best(rule, text):
+    # returns (best tree, its probability, inside probability of the sentence);
+    # pass a PCFG to avoid building the arrays on every call
+    pcfg = rule if isinstance(rule, PCFG) else PCFG(rule)
+    tokens = text.lower().split()
+    prob, tree = pcfg.viterbi(tokens)
+    if not prob:
+        raise ValueError("parsing failed")
+    total = pcfg.inside(tokens)[0, len(tokens), pcfg.cnf.start] if tokens else pcfg.empty_prob
+    return tree, prob, total
 
 
+if __name__ == "__main__":
+    SYM = Rule("SYM", Production("a"))
+    OP = Rule("OP", Production("+"))
+    EXPR = Rule("EXPR", Production(SYM))
+    EXPR.add(Production(EXPR, OP, EXPR))
+    cnf = CNF(EXPR)
+    for i in range(1, 21):
+        text = " + ".join(["a"] * i)
+        print parse(cnf, text).count(), text
 
+    N = Rule("N", Production("time"), Production("flight"), Production("banana"),
+        Production("flies"), Production("boy"), Production("telescope"))
+    D = Rule("D", Production("the"), Production("a"), Production("an"))
+    V = Rule("V", Production("book"), Production("eat"), Production("sleep"), Production("saw"))
+    P = Rule("P", Production("with"), Production("in"), Production("on"), Production("at"),
+        Production("through"))
 
+    PP = Rule("PP")
+    NP = Rule("NP", Production(D, N), Production("john"), Production("houston"))
+    NP.add(Production(NP, PP))
+    PP.add(Production(P, NP))
 
+    VP = Rule("VP", Production(V, NP))
+    VP.add(Production(VP, PP))
+    S = Rule("S", Production(NP, VP), Production(VP))
 
+    for tree in parse(S, "john saw the boy with the telescope"):
+        print "--------------------------"
+        tree.print_()
 
+    # the same grammar with probabilities
+    N = Rule("N", Production("boy", prob = 0.5), Production("telescope", prob = 0.5))
+    NP = Rule("NP", Production(D, N, prob = 0.6), Production("john", prob = 0.3))
+    PP = Rule("PP", Production(P, NP))
+    NP.add(Production(NP, PP, prob = 0.1))
+    VP = Rule("VP", Production(V, NP, prob = 0.8))
+    VP.add(Production(VP, PP, prob = 0.2))
+    S = Rule("S", Production(NP, VP))
 
+    tree, prob, inside = parse_best(S, "john saw the boy with the telescope")
+    print "--------------------------"
+    print "best tree (p = %g out of %g)" % (prob, inside)
+    tree.print_()
@@ -127,45 +127,22 @@ N = Rule("N", ["fruit"], ["fruits"], ["fly"], ["flies"])
 NP = Rule("NP", [N], [DET, N])
 NP.add([N, NP])
 
-X = Rule("X", ["x"])
-X.add([X, "+", X], [X, "*", X])
-
-ep = EarleyParser(X, "x + x * x")
-dr = ep.parse()
-
-if not dr:
-    print "failed!"
-
 def print_bp(dr, i=0):
     if dr is None:
         return
     print "  " * i + str(dr)
     for bp in dr.backlinks:
         print_bp(bp, i+1) 
-
-print_bp(dr)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
 
 
+if __name__ == "__main__":
+    X = Rule("X", ["x"])
+    X.add([X, "+", X], [X, "*", X])
 
+    ep = EarleyParser(X, "x + x * x")
+    dr = ep.parse()
 
+    if not dr:
+        print "failed!"
 
+    print_bp(dr)
@@ -1,3 +1,6 @@
+import weakref
+
+
 class Production(object):
     def __init__(self, *terms):
         self.terms = tuple(t.lower() if isinstance(t, str) else t for t in terms)
@@ -26,6 +29,8 @@ class Rule(object):
         return "%s -> %s" % (self.name, " | ".join(str(r) for r in self.productions))
     def add(self, *productions):
         self.productions.extend(productions)
+        # a new production may make any rule that reaches this one nullable
+        _nullable_cache.clear()
     def __len__(self):
         return len(self.productions)
     def __iter__(self):
@@ -85,7 +90,38 @@ class Column(object):
     def __iter__(self):
         return iter(self.states)
 
-def _predict(col, state):
+# returns the names of the rules (reachable from root) that derive epsilon
+def find_nullable(root):
+    rules = {}
+    pending = [root]
+    while pending:
+        rule = pending.pop()
+        if rule.name not in rules:
+            rules[rule.name] = rule
+            pending.extend(t for prod in rule for t in prod if isinstance(t, Rule))
+    nullable = set()
+    changed = True
+    while changed:
+        changed = False
+        for rule in rules.values():
+            if rule.name in nullable:
+                continue
+            if any(all(isinstance(t, Rule) and t.name in nullable for t in prod) for prod in rule):
+                nullable.add(rule.name)
+                changed = True
+    return nullable
+
+# root rule -> find_nullable(root), so that parsing with the same grammar 
+# doesn't run the fixpoint again; Rule.add() drops it all
+_nullable_cache = weakref.WeakKeyDictionary()
+
+def get_nullable(root):
+    nullable = _nullable_cache.get(root)
+    if nullable is None:
+        nullable = _nullable_cache[root] = find_nullable(root)
+    return nullable
+
+def _predict(col, state, nullable):
     rule = state.next_term()
     if not isinstance(rule, Rule):
         return False
@@ -93,6 +129,11 @@ def _predict(col, state):
     for prod in rule:
         if col.add(State(rule.name, prod, 0, col)):
             changed = True
+    # a nullable rule may complete in this column before or after this state
+    # got here, so move the dot over it right away [Aycock & Horspool 02]
+    if rule.name in nullable:
+        if col.add(State(state.name, state.production, state.dot_index + 1, state.start_column)):
+            changed = True
     return changed
 
 def _scan(col2, state, term):
@@ -113,16 +154,8 @@ def _complete(col, state):
 
     return changed
 
-def _handle_epsilon(col):
-    changed = True
-    while changed:
-        changed = False
-        for state in col:
-            if _complete(col, state):
-                changed = True
-            _predict(col, state)
-
 def parse(root, text):
+    nullable = get_nullable(root)
     table = [Column(i, tok) for i, tok in enumerate([None] + text.lower().split())]
     table[0].add(State("q0", Production(root), 0, table[0]))
     
@@ -134,11 +167,10 @@ def parse(root, text):
             else:
                 term = state.next_term()
                 if isinstance(term, Rule): 
-                    _predict(col, state)
+                    _predict(col, state, nullable)
                 elif isinstance(term, str) and i+1 < len(table): 
                     _scan(table[i+1], state, term)
                 
-        _handle_epsilon(col)
         table[i].print_()
     
     for state in table[-1]:
@@ -146,7 +178,7 @@ def parse(root, text):
             q0 = state
             break
     else:
-        raise Exception("parsing failed")
+        raise ValueError("parsing failed")
     
     #return build_trees(table, q0)
 
@@ -154,12 +186,6 @@ def parse(root, text):
 #EXPR = Rule("EXPR", Production("x"))
 #EXPR.add(Production(EXPR, "+", EXPR), Production(EXPR, "*", EXPR))
 
-Q = Rule("Q", Production("+"), Production("*"))
-F = Rule("F", Production("x"))
-E = Rule("E", Production(F))
-E.add(Production(E, Q, E))
-root = parse(E, "x + x * x")     # (x+x)*x, x+(x*x)
-
 def build_trees(table, state, level = 0):
     print "  " * level + str(state)
     rules = [t for t in state.production[::-1] if isinstance(t, Rule)]
@@ -172,26 +198,13 @@ def build_trees(table, state, level = 0):
             continue
         build_trees(st, level + 1)
 
-#print "==========================================="
-#build_trees(root)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
 
+if __name__ == "__main__":
+    Q = Rule("Q", Production("+"), Production("*"))
+    F = Rule("F", Production("x"))
+    E = Rule("E", Production(F))
+    E.add(Production(E, Q, E))
+    root = parse(E, "x + x * x")     # (x+x)*x, x+(x*x)
 
+    #print "==========================================="
+    #build_trees(root)
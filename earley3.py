@@ -1,6 +1,20 @@
+import os
+import random
+import cPickle
+import hashlib
+import weakref
+import resource
+import itertools
+import collections
+import multiprocessing
+
 class Production(object):
-    def __init__(self, *terms):
+    def __init__(self, *terms, **kwargs):
         self.terms = terms
+        # the probability of choosing this production for its rule
+        self.prob = kwargs.pop("prob", 1.0)
+        if kwargs:
+            raise TypeError("unexpected keyword arguments %r" % (kwargs.keys(),))
     def __len__(self):
         return len(self.terms)
     def __getitem__(self, index):
@@ -28,39 +42,334 @@ class Rule(object):
         return "%s -> %s" % (self.name, " | ".join(repr(p) for p in self.productions))
     def add(self, *productions):
         self.productions.extend(productions)
+        # a new production changes the hash of any grammar that reaches it
+        _grammar_hashes.clear()
 
-class State(object):
-    def __init__(self, name, production, dot_index, start_column):
+GAMMA_RULE = u"GAMMA"
+
+#===============================================================================
+# Compiled grammar
+#
+# The Rule/Production graph is flattened once into integer tables: every rule
+# gets a symbol id, and every (production, dot index) pair becomes an Item
+# with a running id. States then only refer to an item and a start column,
+# and all the work of predict/scan/complete is reduced to following links
+# between precomputed items
+#===============================================================================
+class Item(object):
+    __slots__ = ["id", "lhs", "name", "production", "dot_index", "rules", 
+        "next_term", "next_symbol", "next_nullable", "completed", "prev", "advance", 
+        "predicts", "prob", "lexical"]
+    def __init__(self, id, lhs, name, production, dot_index, rules):
+        self.id = id
+        self.lhs = lhs
         self.name = name
         self.production = production
+        self.dot_index = dot_index
+        self.rules = rules
+        self.prob = production.prob
+        self.completed = dot_index >= len(production)
+        self.next_term = None if self.completed else production[dot_index]
+        self.next_symbol = None     # symbol id, if next_term is a rule
+        self.next_nullable = False  # whether next_term can derive the empty string
+        self.prev = None            # the item with the dot one term to the left
+        self.advance = None         # the item with the dot one term to the right
+        self.predicts = ()          # the initial items of the next_term rule
+        self.lexical = False        # whether this is an item of a pre-terminal rule
+
+class Grammar(object):
+    def __init__(self, start):
+        gamma = Rule(GAMMA_RULE, Production(start))
+        self.rules = []           # symbol id -> rule
+        self.symbol_ids = {}      # rule name -> symbol id
+        self.items = []           # item id -> item
+        self.initial_items = []   # symbol id -> the dot-0 items of its productions
+        self.lexicon = {}         # token -> [(pre-terminal symbol id, production)]
+        self.words = {}           # pre-terminal symbol id -> its tokens
+        self._lexical_items = {}  # token -> completed items of pre-terminals
+        pending = [gamma]
+        while pending:
+            rule = pending.pop(0)
+            if rule.name in self.symbol_ids:
+                continue
+            self.symbol_ids[rule.name] = len(self.rules)
+            self.rules.append(rule)
+            for prod in rule.productions:
+                pending.extend(t for t in prod if isinstance(t, Rule))
+
+        for sym, rule in enumerate(self.rules):
+            # pre-terminals (rules whose productions are all single tokens) are 
+            # never predicted: scanning looks the token up in the lexicon, and
+            # their items are only made for the tokens that actually show up
+            if sym > 0 and rule.productions and all(len(prod) == 1 and 
+                    not isinstance(prod[0], Rule) for prod in rule.productions):
+                self.words[sym] = [prod[0] for prod in rule.productions]
+                for prod in rule.productions:
+                    self.lexicon.setdefault(prod[0], []).append((sym, prod))
+                self.initial_items.append([])
+                continue
+            initials = []
+            for prod in rule.productions:
+                rules = tuple(t for t in prod if isinstance(t, Rule))
+                prev = None
+                for dot_index in range(len(prod) + 1):
+                    item = Item(len(self.items), sym, rule.name, prod, dot_index, rules)
+                    self.items.append(item)
+                    if prev is None:
+                        initials.append(item)
+                    else:
+                        prev.advance = item
+                        item.prev = prev
+                    prev = item
+            self.initial_items.append(initials)
+        self.nullable = self._find_nullable()
+        for item in self.items:
+            if isinstance(item.next_term, Rule):
+                item.next_symbol = self.symbol_ids[item.next_term.name]
+                item.next_nullable = item.next_symbol in self.nullable
+                if item.next_symbol not in self.words:
+                    item.predicts = self.initial_items[item.next_symbol]
+        self.start_item = self.initial_items[0][0]
+        self._hash = None
+
+    def lexical_items(self, token):
+        # the completed items of the pre-terminals deriving token. Tokens
+        # outside the lexicon aren't cached, so the cache is bounded by the
+        # lexicon however many unknown tokens are scanned
+        items = self._lexical_items.get(token)
+        if items is None:
+            if token not in self.lexicon:
+                return []
+            items = self._lexical_items[token] = []
+            for sym, prod in self.lexicon[token]:
+                if not isinstance(prod, Production):
+                    # a loaded grammar keeps only the probability
+                    prod = Production(token, prob = prod)
+                item = Item(len(self.items), sym, self.rules[sym].name, prod, 1, ())
+                item.lexical = True
+                self.items.append(item)
+                items.append(item)
+        return items
+
+    def content_hash(self):
+        # identifies the grammar by its rules, productions and probabilities
+        if self._hash is None:
+            self._hash = _rules_hash(self.rules)
+        return self._hash
+
+    # pickled flat: items and rules refer to one another by index, so that 
+    # neither pickling nor unpickling recurses along the links. Pre-terminals
+    # keep just their words and probabilities (see _PreTerminal)
+    def __getstate__(self):
+        index = dict((id(rule), sym) for sym, rule in enumerate(self.rules))
+        rules = [(rule.name, None if sym in self.words else [(tuple((index[id(t)],) 
+            if isinstance(t, Rule) else t for t in prod), prod.prob) 
+            for prod in rule.productions]) for sym, rule in enumerate(self.rules)]
+        prod_index = dict((id(prod), (sym, i)) for sym, rule in enumerate(self.rules) 
+            if sym not in self.words for i, prod in enumerate(rule.productions))
+        items = [(item.lhs, prod_index[id(item.production)], item.dot_index, 
+            item.next_symbol, item.next_nullable, bool(item.predicts)) 
+            for item in self.items if not item.lexical]
+        lexicon = dict((token, [(sym, p.prob if isinstance(p, Production) else p) 
+            for sym, p in entries]) for token, entries in self.lexicon.items())
+        return dict(rules = rules, items = items, lexicon = lexicon, 
+            nullable = self.nullable, words = self.words, hash = self.content_hash())
+
+    def __setstate__(self, state):
+        self.nullable = state["nullable"]
+        self.words = state["words"]
+        self.lexicon = state["lexicon"]
+        self._lexical_items = {}
+        self._hash = state["hash"]
+        self.rules = [_PreTerminal(name, self, sym) if prods is None else Rule(name) 
+            for sym, (name, prods) in enumerate(state["rules"])]
+        for rule, (name, prods) in zip(self.rules, state["rules"]):
+            if prods is not None:
+                rule.productions = [Production(*[self.rules[t[0]] if isinstance(t, tuple) 
+                    else t for t in terms], prob = prob) for terms, prob in prods]
+        self.symbol_ids = dict((rule.name, sym) for sym, rule in enumerate(self.rules))
+        self.items = []
+        self.initial_items = [[] for rule in self.rules]
+        for lhs, (sym, i), dot_index, next_symbol, next_nullable, predicts in state["items"]:
+            prod = self.rules[sym].productions[i]
+            rules = tuple(t for t in prod if isinstance(t, Rule))
+            item = Item(len(self.items), lhs, self.rules[lhs].name, prod, dot_index, rules)
+            item.next_symbol = next_symbol
+            item.next_nullable = next_nullable
+            if dot_index == 0:
+                self.initial_items[lhs].append(item)
+            else:
+                item.prev = self.items[-1]
+                item.prev.advance = item
+            self.items.append(item)
+        for item, entry in zip(self.items, state["items"]):
+            if entry[-1]:
+                item.predicts = self.initial_items[item.next_symbol]
+        self.start_item = self.initial_items[0][0]
+
+    def _find_nullable(self):
+        # the symbol ids of rules that derive the empty string, to a fixpoint
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for sym, rule in enumerate(self.rules):
+                if sym in nullable:
+                    continue
+                for prod in rule.productions:
+                    if all(isinstance(t, Rule) and self.symbol_ids[t.name] in nullable 
+                            for t in prod):
+                        nullable.add(sym)
+                        changed = True
+                        break
+        return nullable
+
+class _PreTerminal(Rule):
+    # the rule of a pre-terminal in a loaded grammar: its productions are only
+    # made when asked for, as a big lexicon would otherwise dominate loading
+    def __init__(self, name, grammar, sym):
+        self.name = name
+        self._grammar = grammar
+        self._sym = sym
+        self._productions = None
+    @property
+    def productions(self):
+        if self._productions is None:
+            self._productions = [Production(token, prob = prob) 
+                for token in _unique(self._grammar.words[self._sym]) 
+                for sym, prob in self._grammar.lexicon[token] if sym == self._sym]
+        return self._productions
+    def add(self, *productions):
+        raise TypeError("the rules of a compiled grammar cannot be changed")
+
+def _unique(seq):
+    seen = set()
+    return [x for x in seq if not (x in seen or seen.add(x))]
+
+def _rules_hash(rules):
+    # rules in symbol order, as Grammar numbers them
+    index = dict((id(rule), sym) for sym, rule in enumerate(rules))
+    h = hashlib.sha1()
+    for rule in rules:
+        h.update(repr((rule.name, [([("rule", index[id(t)]) if isinstance(t, Rule) 
+            else t for t in prod.terms], prod.prob) for prod in rule.productions])))
+    return h.hexdigest()
+
+# start rule -> grammar_hash(start), so that a ParseCache hit with the same 
+# start rule doesn't walk the grammar again; Rule.add() drops it all
+_grammar_hashes = weakref.WeakKeyDictionary()
+
+def grammar_hash(start):
+    # the content_hash() that Grammar(start) would have, without compiling it
+    h = _grammar_hashes.get(start)
+    if h is None:
+        h = _grammar_hashes[start] = _start_hash(start)
+    return h
+
+def _start_hash(start):
+    rules = []
+    seen = set()
+    pending = [Rule(GAMMA_RULE, Production(start))]
+    while pending:
+        rule = pending.pop(0)
+        if rule.name in seen:
+            continue
+        seen.add(rule.name)
+        rules.append(rule)
+        for prod in rule.productions:
+            pending.extend(t for t in prod.terms if isinstance(t, Rule))
+    return _rules_hash(rules)
+
+#===============================================================================
+# Persisted grammars
+#
+# A compiled grammar is saved as a small header (format version and content 
+# hash), followed by the grammar itself, so a stale or foreign file is turned 
+# down before the (single) unpickling of the payload
+#===============================================================================
+GRAMMAR_MAGIC = "earley3-grammar"
+GRAMMAR_FORMAT = 1
+
+def save_grammar(grammar, path):
+    # written to a temporary file and renamed, so readers never see half a file
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        cPickle.dump((GRAMMAR_MAGIC, GRAMMAR_FORMAT, grammar.content_hash()), f, 2)
+        cPickle.dump(grammar, f, 2)
+    os.rename(tmp, path)
+
+def load_grammar(path, expected_hash = None):
+    # raises ValueError if the file is of another format version, or does not
+    # hold the expected grammar
+    with open(path, "rb") as f:
+        header = cPickle.load(f)
+        if not isinstance(header, tuple) or header[:2] != (GRAMMAR_MAGIC, GRAMMAR_FORMAT):
+            raise ValueError("%s: not a grammar of format %d" % (path, GRAMMAR_FORMAT))
+        if expected_hash is not None and header[2] != expected_hash:
+            raise ValueError("%s: grammar hash mismatch" % (path,))
+        return cPickle.load(f)
+
+def cached_grammar(start, path):
+    # loads the compiled grammar from path if it holds this very grammar, or
+    # compiles it and saves it there for next time
+    h = grammar_hash(start)
+    try:
+        return load_grammar(path, h)
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+        pass
+    grammar = Grammar(start)
+    save_grammar(grammar, path)
+    return grammar
+
+class State(object):
+    __slots__ = ["item", "start_column", "end_column", "key", "inner", "forward"]
+    def __init__(self, item, start_column, inner = 1.0, forward = 1.0):
+        self.item = item
         self.start_column = start_column
         self.end_column = None
-        self.dot_index = dot_index
-        self.rules = [t for t in production if isinstance(t, Rule)]
+        # a packed int, unique per (item, start column)
+        self.key = (start_column.index << 32) | item.id
+        # best probabilities found so far for the part of the production left 
+        # of the dot (inner), and for the whole prefix of the sentence up to 
+        # this state (forward). They drive beam pruning only
+        self.inner = inner
+        self.forward = forward
+    @property
+    def name(self):
+        return self.item.name
+    @property
+    def production(self):
+        return self.item.production
+    @property
+    def dot_index(self):
+        return self.item.dot_index
+    @property
+    def rules(self):
+        return self.item.rules
     def __repr__(self):
         terms = [str(p) for p in self.production]
         terms.insert(self.dot_index, u"$")
         return "%-5s -> %-16s [%s-%s]" % (self.name, " ".join(terms), self.start_column, self.end_column)
     def __eq__(self, other):
-        return (self.name, self.production, self.dot_index, self.start_column) == \
-            (other.name, other.production, other.dot_index, other.start_column)
+        return self.key == other.key
     def __ne__(self, other):
         return not (self == other)
     def __hash__(self):
-        return hash((self.name, self.production))
+        return hash(self.key)
     def completed(self):
-        return self.dot_index >= len(self.production)
+        return self.item.completed
     def next_term(self):
-        if self.completed():
-            return None
-        return self.production[self.dot_index]
+        return self.item.next_term
 
 class Column(object):
     def __init__(self, index, token):
         self.index = index
         self.token = token
         self.states = []
-        self._unique = set()
+        self._unique = {}
+        self._waiting = {}
+        self._scanning = []
+        self._leo = {}
     def __str__(self):
         return str(self.index)
     def __len__(self):
@@ -69,16 +378,57 @@ class Column(object):
         return iter(self.states)
     def __getitem__(self, index):
         return self.states[index]
+    def __contains__(self, state):
+        return state in self._unique
     def enumfrom(self, index):
         for i in range(index, len(self.states)):
             yield i, self.states[i]
     def add(self, state):
-        if state not in self._unique:
-            self._unique.add(state)
+        existing = self._unique.get(state)
+        if existing is None:
+            self._unique[state] = state
             state.end_column = self
             self.states.append(state)
+            item = state.item
+            if item.next_symbol is not None:
+                self._waiting.setdefault(item.next_symbol, []).append(state)
+            elif not item.completed:
+                self._scanning.append(state)
             return True
+        existing.inner = max(existing.inner, state.inner)
+        existing.forward = max(existing.forward, state.forward)
         return False
+    def prune(self, beam):
+        # drops states whose forward probability is below beam times the best
+        # one from the waiting/scanning indexes, so they are never advanced
+        if not self.states:
+            return
+        threshold = beam * max(st.forward for st in self.states)
+        for symbol, states in self._waiting.items():
+            self._waiting[symbol] = [st for st in states if st.forward >= threshold]
+        self._scanning = [st for st in self._scanning if st.forward >= threshold]
+    def waiting_for(self, symbol):
+        return self._waiting.get(symbol, ())
+    def waiting_symbols(self):
+        return [sym for sym, states in self._waiting.items() if states]
+    def leo_item(self, symbol):
+        # the topmost (item, start column) of the deterministic reduction path
+        # for the given symbol [Leo 91], or None. Only valid once the column
+        # is fully processed
+        if symbol not in self._leo:
+            self._leo[symbol] = None
+            waiting = self.waiting_for(symbol)
+            if len(waiting) == 1 and waiting[0].item.advance.completed:
+                st = waiting[0]
+                top = None
+                if st.start_column is not self:
+                    top = st.start_column.leo_item(st.item.lhs)
+                self._leo[symbol] = top or (st.item.advance, st.start_column)
+        return self._leo[symbol]
+    def scanning_for(self, token):
+        return [st for st in self._scanning if st.item.next_term == token]
+    def expected_tokens(self):
+        return set(st.item.next_term for st in self._scanning)
     def print_(self, completedOnly = False):
         print "[%s] %r" % (self.index, self.token)
         print "=" * 35
@@ -96,51 +446,318 @@ class Node(object):
         print "  " * level + str(self.value)
         for child in self.children:
             child.print_(level + 1)
+    def bracketed(self):
+        # e.g., "(NP (D the) (N boy))"; terminals are taken from the production
+        children = iter(self.children)
+        terms = [next(children).bracketed() if isinstance(t, Rule) else t 
+            for t in self.value.production]
+        return "(%s %s)" % (self.value.name, " ".join(terms))
 
-def predict(col, rule):
-    for prod in rule.productions:
-        col.add(State(rule.name, prod, 0, col))
+#===============================================================================
+# Parse statistics
+#
+# Filled in by predict/scan/complete when a ParseStats is passed to them (the
+# plain code path is left untouched otherwise), to find out which sentences 
+# and which rules make the chart blow up
+#===============================================================================
+class ParseStats(object):
+    EVENTS = ("predictions", "scans", "completions")
 
-def scan(col, state, token):
-    if token != col.token:
-        return
-    col.add(State(state.name, state.production, state.dot_index + 1, state.start_column))
+    def __init__(self, per_rule = False):
+        self.states = 0         # states created, including duplicates
+        self.duplicates = 0     # states rejected as already in the chart
+        self.predictions = 0    # states created by each operation
+        self.scans = 0
+        self.completions = 0
+        self.column_sizes = []
+        self.peak_memory = 0    # peak RSS of the process, in KB
+        # rule name -> event -> states created
+        self.rules = {} if per_rule else None
+    def __repr__(self):
+        return "ParseStats(%s)" % (", ".join("%s=%r" % (k, v) 
+            for k, v in sorted(self.as_dict().items()) if k != "rules"),)
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in ("states", "duplicates", 
+            "predictions", "scans", "completions", "column_sizes", "peak_memory", "rules"))
+    def adder(self, col, event):
+        # a drop-in for col.add that counts what it is given
+        def add(state):
+            added = col.add(state)
+            self.states += 1
+            if not added:
+                self.duplicates += 1
+            if event is not None:
+                self.count(event, state.item.name)
+            return added
+        return add
+    def count(self, event, name, n = 1):
+        setattr(self, event, getattr(self, event) + n)
+        if self.rules is not None:
+            counters = self.rules.setdefault(name, dict.fromkeys(self.EVENTS, 0))
+            counters[event] += n
+    def column_done(self, col):
+        self.column_sizes.append(len(col))
+        self.update_memory()
+    def update_memory(self):
+        self.peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    def hot_rules(self, count = 10):
+        # the rules that created the most states
+        if not self.rules:
+            return []
+        return sorted(self.rules.items(), key = lambda item: -sum(item[1].values()))[:count]
 
-def complete(col, state):
-    if not state.completed():
-        return
-    for st in state.start_column:
-        term = st.next_term()
-        if not isinstance(term, Rule):
-            continue
-        if term.name == state.name:
-            col.add(State(st.name, st.production, st.dot_index + 1, st.start_column))
+def predict(col, state, stats = None):
+    add = col.add if stats is None else stats.adder(col, "predictions")
+    for item in state.item.predicts:
+        add(State(item, col, item.prob, state.forward * item.prob))
+    # [Aycock & Horspool 02]: a nullable rule may complete in this very column,
+    # possibly before or after this state was added, so skip over it right away
+    if state.item.next_nullable:
+        add(State(state.item.advance, state.start_column, state.inner, state.forward))
 
-GAMMA_RULE = u"GAMMA"
+def scan(col, prev_col, grammar, stats = None):
+    add = col.add if stats is None else stats.adder(col, "scans")
+    for st in prev_col.scanning_for(col.token):
+        add(State(st.item.advance, st.start_column, st.inner, st.forward))
+    # pre-terminals that derive the token complete right away, if anyone 
+    # waits for them
+    for item in grammar.lexical_items(col.token):
+        waiting = prev_col.waiting_for(item.lhs)
+        if waiting:
+            forward = max(st.forward for st in waiting) * item.prob
+            add(State(item, prev_col, item.prob, forward))
+
+def complete(col, state, leo = False, stats = None):
+    if not state.item.completed:
+        return
+    add = col.add if stats is None else stats.adder(col, "completions")
+    if leo and state.start_column is not col:
+        top = state.start_column.leo_item(state.item.lhs)
+        if top is not None:
+            add(State(top[0], top[1], state.inner, state.forward))
+            return
+    for st in state.start_column.waiting_for(state.item.lhs):
+        add(State(st.item.advance, st.start_column, st.inner * state.inner, 
+            st.forward * state.inner))
 
-def parse(rule, text):
-    table = [Column(i, tok) for i, tok in enumerate([None] + text.lower().split())]
-    table[0].add(State(GAMMA_RULE, Production(rule), 0, table[0]))
+# Parses a token stream one token at a time: every feed() scans the last column
+# into a new one and closes it under prediction and completion, so earlier 
+# columns are never revisited, and a prefix that cannot be extended into a 
+# sentence is detected right away.
+# With leo = True, right recursion is recognized in linear time by jumping 
+# straight to the top of deterministic reduction paths; the intermediate 
+# completed states are never added, so such a chart cannot produce a forest.
+# With a beam (e.g., 1e-4), every column drops the states whose forward 
+# probability is less than beam times that of the best state in the column.
+# With stats = True (or a ParseStats of your own, e.g. ParseStats(per_rule = 
+# True)), the parser keeps count of its work in self.stats
+class IncrementalParser(object):
+    def __init__(self, rule, leo = False, beam = None, stats = None):
+        # pass a compiled Grammar to avoid recompiling the rules every time
+        self.grammar = rule if isinstance(rule, Grammar) else Grammar(rule)
+        self.leo = leo
+        self.beam = beam
+        self.stats = ParseStats() if stats is True else (stats or None)
+        self.table = [Column(0, None)]
+        if self.stats is None:
+            self.table[0].add(State(self.grammar.start_item, self.table[0]))
+        else:
+            self.stats.adder(self.table[0], None)(State(self.grammar.start_item, self.table[0]))
+        self._process(self.table[0])
 
-    for i, col in enumerate(table):
+    def _process(self, col):
+        if self.stats is not None:
+            return self._process_with_stats(col)
         for state in col:
-            if state.completed():
-                complete(col, state)
-            else:
-                term = state.next_term()
-                if isinstance(term, Rule):
-                    predict(col, term)
-                elif i + 1 < len(table):
-                    scan(table[i+1], state, term)
-        
+            item = state.item
+            if item.completed:
+                complete(col, state, self.leo)
+            elif item.next_symbol is not None:
+                predict(col, state)
+        if self.beam is not None:
+            col.prune(self.beam)
         #col.print_(completedOnly = True)
 
-    # find gamma rule in last table column (otherwise fail)
-    for st in table[-1]:
-        if st.name == GAMMA_RULE and st.completed():
-            return st
-    else:
-        raise ValueError("parsing failed")
+    def _process_with_stats(self, col):
+        for state in col:
+            item = state.item
+            if item.completed:
+                complete(col, state, self.leo, self.stats)
+            elif item.next_symbol is not None:
+                predict(col, state, self.stats)
+        if self.beam is not None:
+            col.prune(self.beam)
+        self.stats.column_done(col)
+
+    def feed(self, token):
+        col = Column(len(self.table), token)
+        scan(col, self.table[-1], self.grammar, self.stats)
+        self.table.append(col)
+        self._process(col)
+        return self.is_viable()
+
+    def is_viable(self):
+        # an empty column means no state could scan the last token
+        return len(self.table[-1]) > 0
+
+    def expected_tokens(self):
+        col = self.table[-1]
+        tokens = col.expected_tokens()
+        for sym in col.waiting_symbols():
+            tokens.update(self.grammar.words.get(sym, ()))
+        return tokens
+
+    def finish(self, forest = False):
+        if forest and self.leo:
+            raise ValueError("cannot build a forest from a chart parsed with leo")
+        # find gamma rule in last table column (otherwise fail)
+        for st in self.table[-1]:
+            if st.item is self.grammar.start_item.advance:
+                if forest:
+                    return Forest(self.table, st)
+                return st
+        else:
+            raise ValueError("parsing failed")
+
+def parse(rule, text, forest = False, leo = False, beam = None, stats = None, 
+        cache = None):
+    # with stats, returns (result, stats) -- see IncrementalParser. The stats
+    # are attached to the ValueError as well when parsing fails. With a 
+    # ParseCache (and no stats), a sentence parsed before is not parsed again
+    if cache is not None and stats is None:
+        return cache.parse(rule, text, forest, leo, beam)
+    parser = IncrementalParser(rule, leo, beam, stats)
+    for tok in text.lower().split():
+        if not parser.feed(tok):
+            break
+    if parser.stats is None:
+        return parser.finish(forest)
+    try:
+        return parser.finish(forest), parser.stats
+    except ValueError as ex:
+        ex.stats = parser.stats
+        raise
+
+def parse_best(rule, text, beam = None):
+    # returns (best tree, its probability, inside probability of the sentence),
+    # computed over the forest without enumerating it
+    forest = parse(rule, text, forest = True, beam = beam)
+    prob, tree = forest.viterbi()
+    return tree, prob, forest.inside()
+
+#===============================================================================
+# Parse cache
+#
+# A least-recently-used cache of parse() results, for traffic that repeats 
+# sentences. Results are keyed by the content hash of the grammar, the start
+# symbol, the tokens and the options that change the result; beyond `size` 
+# entries, the least recently used one is evicted. Failures are cached too, 
+# and raised again. Cached states and forests are shared by every hit, so 
+# they must not be changed. The counters tell how well `size` fits the traffic
+#===============================================================================
+class ParseCache(object):
+    def __init__(self, size = 1024):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+    def __len__(self):
+        return len(self._entries)
+    def __repr__(self):
+        return "ParseCache(%s)" % (", ".join("%s=%r" % (k, v) 
+            for k, v in sorted(self.as_dict().items())),)
+    def as_dict(self):
+        return dict(size = self.size, entries = len(self._entries), hits = self.hits,
+            misses = self.misses, evictions = self.evictions)
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, key):
+        # the cached entry, now the most recently used one, or None
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = entry
+        return entry
+    def put(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last = False)
+            self.evictions += 1
+
+    def parse(self, rule, text, forest = False, leo = False, beam = None):
+        if isinstance(rule, Grammar):
+            h = rule.content_hash()
+            start = rule.rules[0].productions[0][0].name
+        else:
+            h = grammar_hash(rule)
+            start = rule.name
+        key = (h, start, tuple(text.lower().split()), forest, leo, beam)
+        entry = self.get(key)
+        if entry is None:
+            try:
+                entry = (parse(rule, text, forest, leo, beam), None)
+            except ValueError as ex:
+                entry = (None, ex)
+            self.put(key, entry)
+        result, error = entry
+        if error is not None:
+            raise error
+        return result
+
+#===============================================================================
+# Batch parsing
+#
+# The grammar is compiled once and handed to the pool's initializer, so each 
+# worker receives it a single time (by fork, where available), and only 
+# sentences and bracketed trees travel between the processes
+#===============================================================================
+_worker_grammar = None
+
+def _init_worker(grammar):
+    global _worker_grammar
+    _worker_grammar = grammar
+
+def _parse_one(job):
+    index, text, max_trees = job
+    try:
+        forest = parse(_worker_grammar, text, forest = True)
+        trees = [tree.children[0].bracketed() for tree in itertools.islice(forest, max_trees)]
+        return index, (forest.count(), trees), None
+    except Exception as ex:
+        return index, None, "%s: %s" % (type(ex).__name__, ex)
+
+def parse_many(grammar, sentences, workers = None, ordered = True, max_trees = 1, 
+        chunksize = 16):
+    # yields (index, (number of trees, first max_trees bracketed trees), error)
+    # for every sentence; error is None on success, otherwise the result is 
+    # None and error describes the failure. With ordered = False, results 
+    # are yielded as soon as they complete
+    if not isinstance(grammar, Grammar):
+        grammar = Grammar(grammar)
+    jobs = ((i, text, max_trees) for i, text in enumerate(sentences))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        _init_worker(grammar)
+        for res in itertools.imap(_parse_one, jobs):
+            yield res
+        return
+    pool = multiprocessing.Pool(workers, _init_worker, (grammar,))
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for res in imap(_parse_one, jobs, chunksize):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 def build_trees(state):
     return build_trees_helper([], state, len(state.rules) - 1, state.end_column)
@@ -167,50 +784,248 @@ def build_trees_helper(children, state, rule_index, end_column):
                 outputs.append(node)
     return outputs
 
+#===============================================================================
+# Shared packed parse forest
+#
+# Instead of materializing every tree, the forest shares subtrees: a SymbolNode
+# stands for all derivations of a rule over a span, and holds one family per
+# completed state (i.e., per production). Productions are binarized through
+# PrefixNodes, so each node has at most O(n) families and the whole forest
+# stays polynomial in the sentence length, however ambiguous the grammar is
+#===============================================================================
+# marks a symbol node whose count is being computed; reaching it again means
+# that it derives itself (e.g., through A -> A B, with B nullable), and so has
+# infinitely many derivations. Every cycle of the forest goes through a symbol
+# node, as prefix nodes only lead to shorter prefixes
+_COUNTING = object()
 
-SYM = Rule("SYM", Production("a"))
-OP = Rule("OP", Production("+"))
-EXPR = Rule("EXPR", Production(SYM))
-EXPR.add(Production(EXPR, OP, EXPR))
-
-for i in range(1,9):
-    text = " + ".join(["a"] * i)
-    q0 = parse(EXPR, text)
-    forest = build_trees(q0)
-    print len(forest), text
-
-
-N = Rule("N", Production("time"), Production("flight"), Production("banana"), 
-    Production("flies"), Production("boy"), Production("telescope"))
-D = Rule("D", Production("the"), Production("a"), Production("an"))
-V = Rule("V", Production("book"), Production("eat"), Production("sleep"), Production("saw"))
-P = Rule("P", Production("with"), Production("in"), Production("on"), Production("at"),
-    Production("through"))
+class SymbolNode(object):
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.families = []     # (completed state, prefix node)
+        self._count = None
+        self._inside = None
+        self._viterbi = None
+    def __repr__(self):
+        return "%s[%s-%s]" % (self.name, self.start, self.end)
+    def count(self):
+        if self._count is None:
+            self._count = _COUNTING
+            try:
+                self._count = sum(prefix.count() for _, prefix in self.families)
+            finally:
+                if self._count is _COUNTING:
+                    self._count = None
+        elif self._count is _COUNTING:
+            raise ValueError("%r derives itself, so it has infinitely many derivations" % (self,))
+        return self._count
+    def inside(self):
+        if self._inside is None:
+            self._inside = sum(state.item.prob * prefix.inside() 
+                for state, prefix in self.families)
+        return self._inside
+    def viterbi(self):
+        # (probability, state, prefix node) of the best family
+        if self._viterbi is None:
+            self._viterbi = max(((state.item.prob * prefix.viterbi()[0], state, prefix)
+                for state, prefix in self.families), key = lambda v: v[0])
+        return self._viterbi
+    def best_tree(self):
+        _, state, prefix = self.viterbi()
+        return Node(state, prefix.best_children())
+    def sample(self, rand):
+        state, prefix = _pick(rand, self.families, lambda family: family[1].count())
+        return Node(state, prefix.sample(rand))
+    def __iter__(self):
+        for state, prefix in self.families:
+            for children in prefix:
+                yield Node(state, children)
 
-PP = Rule("PP")
-NP = Rule("NP", Production(D, N), Production("john"), Production("houston"))
-NP.add(Production(NP, PP))
-PP.add(Production(P, NP))
+class PrefixNode(object):
+    def __init__(self, dot_index, start, end):
+        self.dot_index = dot_index
+        self.start = start
+        self.end = end
+        self.families = []     # (shorter prefix node or None, symbol node or None)
+        self._count = None
+        self._inside = None
+        self._viterbi = None
+    def count(self):
+        if self._count is None:
+            if self.dot_index == 0:
+                self._count = 1
+            else:
+                self._count = sum(self._weight(f) for f in self.families)
+        return self._count
+    def inside(self):
+        if self._inside is None:
+            if self.dot_index == 0:
+                self._inside = 1.0
+            else:
+                self._inside = sum((1.0 if left is None else left.inside()) * 
+                    (1.0 if child is None else child.inside()) for left, child in self.families)
+        return self._inside
+    def viterbi(self):
+        # (probability, best family)
+        if self._viterbi is None:
+            if self.dot_index == 0:
+                self._viterbi = (1.0, None)
+            else:
+                self._viterbi = max((((1.0 if left is None else left.viterbi()[0]) * 
+                    (1.0 if child is None else child.viterbi()[0]), (left, child)) 
+                    for left, child in self.families), key = lambda v: v[0])
+        return self._viterbi
+    def best_children(self):
+        if self.dot_index == 0:
+            return []
+        left, child = self.viterbi()[1]
+        children = [] if left is None else left.best_children()
+        if child is not None:
+            children.append(child.best_tree())
+        return children
+    @staticmethod
+    def _weight(family):
+        left, child = family
+        return (1 if left is None else left.count()) * (1 if child is None else child.count())
+    def sample(self, rand):
+        if self.dot_index == 0:
+            return []
+        left, child = _pick(rand, self.families, self._weight)
+        children = [] if left is None else left.sample(rand)
+        if child is not None:
+            children.append(child.sample(rand))
+        return children
+    def __iter__(self):
+        if self.dot_index == 0:
+            yield []
+            return
+        for left, child in self.families:
+            for children in ([[]] if left is None else left):
+                if child is None:
+                    yield children
+                    continue
+                for sub_tree in child:
+                    yield children + [sub_tree]
 
-VP = Rule("VP", Production(V, NP))
-VP.add(Production(VP, PP))
-S = Rule("S", Production(NP, VP), Production(VP))
+def _pick(rand, families, weight):
+    x = rand.random() * sum(weight(f) for f in families)
+    for f in families:
+        x -= weight(f)
+        if x < 0:
+            return f
+    return families[-1]
 
-for tree in build_trees(parse(S, "book the flight through houston")):
-    print "--------------------------"
-    tree.print_()
+class Forest(object):
+    def __init__(self, table, root):
+        self.table = table
+        self._completed = {}
+        self._nodes = {}
+        self.root = self._symbol(root.item.lhs, root.name, root.start_column.index, 
+            root.end_column.index)
+    def __iter__(self):
+        return iter(self.root)
+    def count(self):
+        return self.root.count()
+    def sample(self, rand = random):
+        return self.root.sample(rand)
+    def inside(self):
+        return self.root.inside()
+    def viterbi(self):
+        # returns (probability, tree) of the most probable tree
+        return self.root.viterbi()[0], self.root.best_tree()
 
-for tree in build_trees(parse(S, "john saw the boy with the telescope")):
-    print "--------------------------"
-    tree.print_()
+    def _completed_in(self, end):
+        # completed states of a column, keyed by (symbol, start index)
+        if end not in self._completed:
+            index = self._completed[end] = {}
+            for st in self.table[end]:
+                if st.item.completed:
+                    index.setdefault((st.item.lhs, st.start_column.index), []).append(st)
+        return self._completed[end]
 
+    def _symbol(self, symbol, name, start, end):
+        key = (symbol, start, end)
+        if key not in self._nodes:
+            node = self._nodes[key] = SymbolNode(name, start, end)
+            for st in self._completed_in(end).get((symbol, start), ()):
+                node.families.append((st, self._prefix(st.item, st.start_column, end)))
+        return self._nodes[key]
 
+    def _prefix(self, item, start_column, end):
+        start = start_column.index
+        key = ("prefix", item.id, start, end)
+        if key not in self._nodes:
+            node = self._nodes[key] = PrefixNode(item.dot_index, start, end)
+            if item.lexical:
+                # the dot-0 states of pre-terminals are never added
+                node.families.append((None, None))
+            elif item.dot_index > 0:
+                prev = State(item.prev, start_column)
+                term = item.prev.next_term
+                for mid in range(start, end + 1):
+                    if prev not in self.table[mid]:
+                        continue
+                    if item.prev.next_symbol is not None:
+                        if (item.prev.next_symbol, mid) not in self._completed_in(end):
+                            continue
+                        child = self._symbol(item.prev.next_symbol, term.name, mid, end)
+                    elif mid + 1 == end and self.table[end].token == term:
+                        child = None
+                    else:
+                        continue
+                    left = self._prefix(item.prev, start_column, mid) if item.dot_index > 1 else None
+                    node.families.append((left, child))
+        return self._nodes[key]
 
+if __name__ == "__main__":
+    SYM = Rule("SYM", Production("a"))
+    OP = Rule("OP", Production("+"))
+    EXPR = Rule("EXPR", Production(SYM))
+    EXPR.add(Production(EXPR, OP, EXPR))
 
+    # the number of trees follows the Catalan numbers, so we count them on the
+    # forest instead of enumerating them
+    for i in range(1, 21):
+        text = " + ".join(["a"] * i)
+        forest = parse(EXPR, text, forest = True)
+        print forest.count(), text
 
+    N = Rule("N", Production("time"), Production("flight"), Production("banana"), 
+        Production("flies"), Production("boy"), Production("telescope"))
+    D = Rule("D", Production("the"), Production("a"), Production("an"))
+    V = Rule("V", Production("book"), Production("eat"), Production("sleep"), Production("saw"))
+    P = Rule("P", Production("with"), Production("in"), Production("on"), Production("at"),
+        Production("through"))
 
+    PP = Rule("PP")
+    NP = Rule("NP", Production(D, N), Production("john"), Production("houston"))
+    NP.add(Production(NP, PP))
+    PP.add(Production(P, NP))
 
+    VP = Rule("VP", Production(V, NP))
+    VP.add(Production(VP, PP))
+    S = Rule("S", Production(NP, VP), Production(VP))
 
+    for tree in build_trees(parse(S, "book the flight through houston")):
+        print "--------------------------"
+        tree.print_()
 
+    for tree in parse(S, "john saw the boy with the telescope", forest = True):
+        print "--------------------------"
+        tree.print_()
 
+    # the same grammar with probabilities: the best tree is picked on the forest
+    N = Rule("N", Production("boy", prob = 0.5), Production("telescope", prob = 0.5))
+    NP = Rule("NP", Production(D, N, prob = 0.6), Production("john", prob = 0.3))
+    PP = Rule("PP", Production(P, NP))
+    NP.add(Production(NP, PP, prob = 0.1))
+    VP = Rule("VP", Production(V, NP, prob = 0.8))
+    VP.add(Production(VP, PP, prob = 0.2))
+    S = Rule("S", Production(NP, VP))
 
+    tree, prob, inside = parse_best(S, "john saw the boy with the telescope", beam = 1e-4)
+    print "--------------------------"
+    print "best tree (p = %g out of %g)" % (prob, inside)
+    tree.print_()
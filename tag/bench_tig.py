@@ -0,0 +1,103 @@
+#===============================================================================
+# Times tig5.parse on the grammars of test_english.py and test_catalan.py,
+# and reports the size of the chart it builds
+#===============================================================================
+import gc
+import time
+import random
+import tig5
+from tig5 import NonTerminal, Foot, TIG
+import test_english
+import test_catalan
+
+
+def timeit(func, *args):
+    gc.collect()
+    t0 = time.time()
+    result = func(*args)
+    return time.time() - t0, result
+
+def bench(grammar, start, text, repeat = 3, parse = tig5.parse):
+    tokens = text.split()
+    best = None
+    for i in range(repeat):
+        dt, (trees, stats) = timeit(parse, grammar, start, tokens, False, True)
+        best = dt if best is None else min(best, dt)
+    print "%-52s | %8.4fs | %7d states | %7d dups | %5d trees" % (text[:52], best,
+        sum(stats.column_sizes), stats.duplicates, len(trees))
+    return best
+
+def run_english(repeat = 3):
+    total = 0
+    for text in test_english.sentences:
+        total += bench(test_english.g, test_english.S, text, repeat)
+    print "english: %.4fs in total" % (total,)
+
+def run_catalan(max_length = 10, repeat = 1):
+    total = 0
+    for i in range(1, max_length + 1):
+        total += bench(test_catalan.g, test_catalan.T, " + ".join("a" * i), repeat)
+    print "catalan: %.4fs in total" % (total,)
+
+def make_lexicon_grammar(num_trees = 50000):
+    # test_english's grammar, with a wide lexicon: a fifth of the trees are
+    # of each kind (nouns, adjectives, verbs, determiners and prepositions)
+    S, NP, VP, N, V, D, P, PP, Adj = [NonTerminal(name) for name in 
+        ("S", "NP", "VP", "N", "V", "D", "P", "PP", "Adj")]
+    k = num_trees // 5
+    init_trees = [S(NP, VP)]
+    init_trees += [N("n%d" % (i,)) for i in range(k)]
+    init_trees += [VP(V("v%d" % (i,)), NP) for i in range(k)]
+    init_trees += [NP(D("d%d" % (i,)), N) for i in range(k)]
+    aux_trees = [N(Adj("a%d" % (i,)), Foot(N)) for i in range(k)]
+    aux_trees += [N(Foot(N), PP(P("p%d" % (i,)), NP)) for i in range(k)]
+    return TIG(init_trees, aux_trees), S
+
+def make_lexicon_sentence(num_trees, rand):
+    k = num_trees // 5
+    def np():
+        return ["d%d" % (rand.randrange(k),), "a%d" % (rand.randrange(k),), 
+            "n%d" % (rand.randrange(k),)]
+    words = np() + ["v%d" % (rand.randrange(k),)] + np()
+    words += ["p%d" % (rand.randrange(k),)] + np()
+    words += ["p%d" % (rand.randrange(k),)] + np()
+    return " ".join(words)
+
+def run_lexicon(num_trees = 50000, unfiltered = False, repeat = 3):
+    # anchor filtering, and (if unfiltered) parsing with the whole grammar, 
+    # which predicts every tree of a kind wherever it may start
+    grammar, S = make_lexicon_grammar(num_trees)
+    text = make_lexicon_sentence(num_trees, random.Random(num_trees))
+    print "%d trees, %d words, %d trees selected" % (grammar.num_trees(), 
+        len(text.split()), grammar.select(text.split()).num_trees())
+    bench(grammar, S, text, repeat)
+    if not unfiltered:
+        return
+    orig_select = TIG.select
+    TIG.select = lambda self, tokens: self
+    try:
+        bench(grammar, S, text, 1)
+    finally:
+        TIG.select = orig_select
+
+def run_parallel(workers = None, num_trees = 500, repeat = 1):
+    # parse_parallel against parse, on the lexicon grammar and catalan; the
+    # pool is forked once per span length, which only pays off for long 
+    # sentences, on more than one CPU
+    def parse_parallel(grammar, start, tokens, debug, stats):
+        return tig5.parse_parallel(grammar, start, tokens, workers, debug, stats)
+    grammar, S = make_lexicon_grammar(num_trees)
+    text = make_lexicon_sentence(num_trees, random.Random(num_trees))
+    cases = [(grammar, S, text), 
+        (test_catalan.g, test_catalan.T, " + ".join("a" * 9))]
+    for grammar, start, text in cases:
+        bench(grammar, start, text, repeat)
+        bench(grammar, start, text, repeat, parse_parallel)
+
+
+if __name__ == "__main__":
+    run_english()
+    run_catalan()
+    run_lexicon(500, True)
+    run_lexicon(50000)
+    run_parallel()
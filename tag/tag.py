@@ -10,7 +10,7 @@ class NonTerminal(object):
     def __init__(self, name):
         self.name = name
     def __sub__(self, children):
-        return Tree(S, children)
+        return Tree(self, children)
     def __invert__(self):
         return Foot(self)
     def __str__(self):
@@ -20,13 +20,23 @@ class Tree(object):
     def __init__(self, root, children):
         self.root = root
         self.children = children
-       
+
     def get(self, path):
         node = self
         for p in path:
             node = node.children[p]
         return node
-    
+
+    def nodes(self, path = ()):
+        # yields (path, node) for every node of the tree, in preorder
+        yield path, self
+        for i, child in enumerate(self.children):
+            if isinstance(child, Tree):
+                for item in child.nodes(path + (i,)):
+                    yield item
+            else:
+                yield path + (i,), child
+
     def show(self, indent = 0):
         print "  " * indent + str(self.root)
         for child in self.children:
@@ -37,7 +47,7 @@ class Tree(object):
 
     def is_aux(self):
         return self.find_foot() is not None
-    
+
     def find_foot(self):
         for i, child in enumerate(self.children):
             if isinstance(child, Foot):
@@ -53,12 +63,30 @@ class TAG(object):
         self.elementary_trees = elementary_trees
         self.start_symbol = start_symbol
         self.by_symbol = {}
+        self.init_by_symbol = {}
+        self.aux_by_symbol = {}
+        # symbol -> [(tree, path), ...] of the inner nodes (where auxiliary
+        # trees adjoin) and of the non-terminal leaves (where initial trees
+        # are substituted) of that symbol
+        self.inner_nodes = {}
+        self.subst_nodes = {}
+        self.feet = {}
         for tree in self.elementary_trees:
-            if tree.root not in self.by_symbol:
-                self.by_symbol[tree.root] = []
-            self.by_symbol[tree.root].append(tree)
-        assert self.start_symbol in self.by_symbol
-    
+            self.by_symbol.setdefault(tree.root, []).append(tree)
+            foot = tree.find_foot()
+            if foot is None:
+                self.init_by_symbol.setdefault(tree.root, []).append(tree)
+            else:
+                assert tree.get(foot).nonterminal == tree.root
+                self.aux_by_symbol.setdefault(tree.root, []).append(tree)
+                self.feet[tree] = foot
+            for path, node in tree.nodes():
+                if isinstance(node, Tree):
+                    self.inner_nodes.setdefault(node.root, []).append((tree, path))
+                elif isinstance(node, NonTerminal):
+                    self.subst_nodes.setdefault(node, []).append((tree, path))
+        assert self.start_symbol in self.init_by_symbol
+
     @property
     def init_trees(self):
         return (t for t in self.elementary_trees if not t.is_aux())
@@ -68,6 +96,18 @@ class TAG(object):
         return (t for t in self.elementary_trees if t.is_aux())
 
 
+#===============================================================================
+# States
+#
+# The dot visits every node of a tree four times: left-above (LA) the node,
+# left-below it (LB, before its children), right-below it (RB, after them) and
+# right-above it (RA). An auxiliary tree adjoined at a node is recognized
+# between LA and RB, in place of the node (whose children, between LB and RB,
+# make up the part below the foot). i is where the tree (or the part below the
+# last node passed at LB) begins, j and k are the part below the foot, if it
+# was passed, and l is where the dot is; sat is set at RB if an auxiliary tree
+# was adjoined at the node
+#===============================================================================
 LA = "LA"
 LB = "LB"
 RA = "RA"
@@ -83,13 +123,13 @@ class State(object):
         self.l = l
         self.sat = sat
     def __repr__(self):
-        return "(%r, %r, %r, %r, %r, %r, %r, %r)" % (self.tree, self.dot_addr, self.dot_pos, 
+        return "(%r, %r, %r, %r, %r, %r, %r, %r)" % (self.tree, self.dot_addr, self.dot_pos,
             self.i, self.j, self.k, self.l, self.sat)
     def __hash__(self):
-        return hash((self.tree, self.dot_addr, self.dot_pos, self.i, self.j, self.k, self.l, 
+        return hash((self.tree, self.dot_addr, self.dot_pos, self.i, self.j, self.k, self.l,
             self.sat))
     def __eq__(self, other):
-        return ((self.tree, self.dot_addr, self.dot_pos, self.i, self.j, self.k, self.l, self.sat) == 
+        return ((self.tree, self.dot_addr, self.dot_pos, self.i, self.j, self.k, self.l, self.sat) ==
             (other.tree, other.dot_addr, other.dot_pos, other.i, other.j, other.k, other.l, other.sat))
     def __ne__(self, other):
         return not (self == other)
@@ -105,9 +145,9 @@ class State(object):
         return isinstance(self.at_dot(), Foot)
     def is_nonterminal(self):
         return isinstance(self.at_dot(), NonTerminal)
-    
+
     def clone(self, dot_addr = None, dot_pos = None, i = None, j = None, k = None, l = None, sat = None):
-        return State(self.tree, 
+        return State(self.tree,
             dot_addr if dot_addr is not None else self.dot_addr,
             dot_pos if dot_pos is not None else self.dot_pos,
             i if i is not None else self.i,
@@ -116,83 +156,204 @@ class State(object):
             l if l is not None else self.l,
             sat if sat is not None else self.sat)
 
+def _either(a, b):
+    # at most one of the two parts of a tree holds the foot
+    return a if a is not None else b
 
-def parse(grammar, tokens):
-    tokens = [None] + list(tokens)
-    chart = set()
-    for tree in grammar.init_trees:
-        if tree.root == grammar.start_symbol:
-            chart.add(State(tree, (), LA, 0, None, None, 0, False))
-    
-    while True:
-        before_len = len(chart)
-        for st in tuple(chart):
-            # scan (1) and (2)
-            if st.dot_pos == LA and not st.sat and st.is_terminal():
-                if st.at_dot() == tokens[st.l+1]:
-                    chart.add(st.clone(dot_pos = RA, l = st.l+1))
-                if st.at_dot() == EPSILON:
-                    chart.add(st.clone(dot_pos = RA))
-            
-            # predict (3)
-            if st.dot_pos == LA and not st.sat and st.is_nonterminal():
-                for t in grammar.by_symbol[st.at_dot()]:
-                    chart.add(State(t, (), LA, st.l, None, None, st.l, False))
-                # predict (4): if no OA
-                if False:
-                    chart.add(st.clone(dot_pos = LB))
-            
-            # predict (5)
-            if st.dot_pos == LB and not st.sat and st.is_foot() and st.i == st.l and st.j == st.k == None:
-                #for t in grammar.elementary_trees:
-                #    pass
-                pass
-            
-            # complete (6)
-            if st.dot_pos == RB and not st.sat:
-                for st2 in tuple(chart):
-                    if st2.dot_pos == LA and not st2.sat and st2.i == st2.l == st.i and st2.j == st2.k == None:
-                        if st2.dot_addr == st2.tree.find_foot() and st2.tree in grammar.by_symbol[st.at_dot()]:
-                            chart.add(State(st2.tree, st2.dot_addr, RB, st.i, st.i, st.l, st.l, False))
-                
-            # complete (7)
-            if st.dot_pos == RB and st.sat:
-                for st2 in tuple(chart):
-                    if st2.tree == st.tree and st2.dot_addr == st.dot_addr and st2.dot_pos == LA \
-                            and st.i == st2.l and st.is_nonterminal():
-                        chart.add(State())
-                
-            
-            
-        
-        if len(chart) == before_len:
-            # no more changes -- we're done
-            break
-    
-    print chart
+#===============================================================================
+# Chart
+#
+# The chart doubles as the agenda: every state is processed once, in the order
+# it was added, and the completion rules look up the states processed before
+# it (and itself) by the node and position of their dot, and by the span they
+# begin or end at, or (for complete auxiliary trees) by the span of their foot.
+# This way every combination of states is made exactly once, when the last of
+# them is processed
+#===============================================================================
+class Chart(object):
+    def __init__(self):
+        self.states = []
+        self._seen = set()
+        self._starting = {}     # (tree, dot_addr, dot_pos, i) -> [state, ...]
+        self._ending = {}       # (tree, dot_addr, dot_pos, l) -> [state, ...]
+        self._by_foot = {}      # (tree, j, k) -> [state, ...]
+    def __len__(self):
+        return len(self.states)
+    def __getitem__(self, index):
+        return self.states[index]
+    def add(self, st):
+        if st not in self._seen:
+            self._seen.add(st)
+            self.states.append(st)
+    def mark_processed(self, st):
+        self._starting.setdefault((st.tree, st.dot_addr, st.dot_pos, st.i), []).append(st)
+        self._ending.setdefault((st.tree, st.dot_addr, st.dot_pos, st.l), []).append(st)
+        if st.dot_addr == () and st.dot_pos == RA and st.j is not None:
+            self._by_foot.setdefault((st.tree, st.j, st.k), []).append(st)
+    def starting(self, tree, dot_addr, dot_pos, i):
+        return self._starting.get((tree, dot_addr, dot_pos, i), ())
+    def ending(self, tree, dot_addr, dot_pos, l):
+        return self._ending.get((tree, dot_addr, dot_pos, l), ())
+    def complete_by_foot(self, tree, j, k):
+        return self._by_foot.get((tree, j, k), ())
+    def below(self, tree, dot_addr, i, l):
+        # the parts below the given node, from i to l, without adjunction
+        return [st for st in self.starting(tree, dot_addr, RB, i) if st.l == l and not st.sat]
 
+#===============================================================================
+# Parser
+#
+# An Earley-style recognizer for TAG, after [Joshi & Schabes 97], in O(n^6);
+# adjunction is allowed at every inner node (but feet) of every tree, and
+# substitution at non-terminal leaves:
+#
+#   (1)  scan a terminal                     LA -> RA, l + 1
+#   (2)  scan epsilon                        LA -> RA
+#   (3)  predict the auxiliary trees that may adjoin at an inner node
+#   (4)  predict no adjunction at an inner node, LA -> LB (the part below the
+#        node begins at l)
+#   (5)  predict the parts below the inner nodes an auxiliary tree may have
+#        adjoined at, on reaching its foot
+#   (6)  complete the foot with the part below such a node, LA -> RA
+#   (7)  complete an adjunction: the site at LA, the complete auxiliary tree,
+#        and the part below the site, which its foot spans -> RB, sat
+#   (8)  complete an inner node without adjunction: the node at LA, and the
+#        part below it -> RA
+#   (9)  RB, sat -> RA
+#   (10) predict the initial trees that may be substituted at a leaf
+#   (11) complete a substitution, LA -> RA
+#
+# The dot moves down from LB to the first child (or to RB, without children),
+# and from RA to the next sibling (or to the parent's RB)
+#===============================================================================
+def _handle_left_above(grammar, chart, st, tokens):
+    node = st.tree.get(st.dot_addr)
+    if isinstance(node, str):
+        # (1)
+        if st.l + 1 < len(tokens) and node == tokens[st.l + 1]:
+            chart.add(st.clone(dot_pos = RA, l = st.l + 1))
+        # (2)
+        if node == EPSILON:
+            chart.add(st.clone(dot_pos = RA))
 
+    elif isinstance(node, Foot):
+        for tree, path in grammar.inner_nodes.get(node.nonterminal, ()):
+            # (5)
+            chart.add(State(tree, path, LB, st.l, None, None, st.l, False))
+            # (6), with st as the foot
+            for st2 in chart.starting(tree, path, RB, st.l):
+                if not st2.sat:
+                    chart.add(st.clone(dot_pos = RA, j = st.l, k = st2.l, l = st2.l))
 
+    elif isinstance(node, NonTerminal):
+        for tree in grammar.init_by_symbol.get(node, ()):
+            # (10)
+            chart.add(State(tree, (), LA, st.l, None, None, st.l, False))
+            # (11), with st as the substitution node
+            for st2 in chart.starting(tree, (), RA, st.l):
+                chart.add(st.clone(dot_pos = RA, l = st2.l))
 
+    else:
+        for tree in grammar.aux_by_symbol.get(node.root, ()):
+            # (3)
+            chart.add(State(tree, (), LA, st.l, None, None, st.l, False))
+            # (7), with st as the adjunction site
+            for st2 in chart.starting(tree, (), RA, st.l):
+                for st3 in chart.below(st.tree, st.dot_addr, st2.j, st2.k):
+                    chart.add(State(st.tree, st.dot_addr, RB, st.i, _either(st.j, st3.j),
+                        _either(st.k, st3.k), st2.l, True))
+        # (4)
+        chart.add(State(st.tree, st.dot_addr, LB, st.l, None, None, st.l, False))
+        # (8), with st as the node
+        for st2 in chart.starting(st.tree, st.dot_addr, RB, st.l):
+            if not st2.sat:
+                chart.add(State(st.tree, st.dot_addr, RA, st.i, _either(st.j, st2.j),
+                    _either(st.k, st2.k), st2.l, False))
 
-if __name__ == "__main__":
-    S = NonTerminal("S")
-    t1 = S-["e"]
-    t2 = S-["a", S-["c", ~S, "d"], "b"]
-    g = TAG([t1, t2], S)
-    
-    
-    
-    #parse(g, "e")
-    #parse(g, "aabbeccdd")
+def _handle_left_below(grammar, chart, st):
+    if st.tree.get(st.dot_addr).children:
+        chart.add(st.clone(dot_addr = st.dot_addr + (0,), dot_pos = LA))
+    else:
+        chart.add(st.clone(dot_pos = RB))
 
+def _handle_right_below(grammar, chart, st):
+    if st.sat:
+        # (9)
+        chart.add(st.clone(dot_pos = RA, sat = False))
+        return
 
+    symbol = st.tree.get(st.dot_addr).root
+    for tree in grammar.aux_by_symbol.get(symbol, ()):
+        # (6), with st as the part below the node
+        for st2 in chart.ending(tree, grammar.feet[tree], LA, st.i):
+            chart.add(st2.clone(dot_pos = RA, j = st.i, k = st.l, l = st.l))
+        # (7), with st as the part below the adjunction site
+        for st2 in chart.complete_by_foot(tree, st.i, st.l):
+            for st3 in chart.ending(st.tree, st.dot_addr, LA, st2.i):
+                chart.add(State(st.tree, st.dot_addr, RB, st3.i, _either(st3.j, st.j),
+                    _either(st3.k, st.k), st2.l, True))
+    # (8), with st as the part below the node
+    for st2 in chart.ending(st.tree, st.dot_addr, LA, st.i):
+        chart.add(State(st.tree, st.dot_addr, RA, st2.i, _either(st2.j, st.j),
+            _either(st2.k, st.k), st.l, False))
 
+def _handle_right_above(grammar, chart, st):
+    if st.dot_addr:
+        parent = st.dot_addr[:-1]
+        index = st.dot_addr[-1] + 1
+        if index < len(st.tree.get(parent).children):
+            chart.add(st.clone(dot_addr = parent + (index,), dot_pos = LA))
+        else:
+            chart.add(st.clone(dot_addr = parent, dot_pos = RB))
 
+    elif st.tree in grammar.feet:
+        # (7), with st as the auxiliary tree
+        for tree, path in grammar.inner_nodes.get(st.tree.root, ()):
+            for st2 in chart.below(tree, path, st.j, st.k):
+                for st3 in chart.ending(tree, path, LA, st.i):
+                    chart.add(State(tree, path, RB, st3.i, _either(st3.j, st2.j),
+                        _either(st3.k, st2.k), st.l, True))
 
+    else:
+        # (11), with st as the substituted tree
+        for tree, path in grammar.subst_nodes.get(st.tree.root, ()):
+            for st2 in chart.ending(tree, path, LA, st.i):
+                chart.add(st2.clone(dot_pos = RA, l = st.l))
 
+def parse(grammar, tokens):
+    # returns the states that recognize the whole of tokens, by an initial
+    # tree of the start symbol (none, if the grammar does not derive them)
+    tokens = [None] + list(tokens)
+    chart = Chart()
+    for tree in grammar.init_by_symbol[grammar.start_symbol]:
+        chart.add(State(tree, (), LA, 0, None, None, 0, False))
 
+    k = 0
+    while k < len(chart):
+        st = chart[k]
+        chart.mark_processed(st)
+        if st.dot_pos == LA:
+            _handle_left_above(grammar, chart, st, tokens)
+        elif st.dot_pos == LB:
+            _handle_left_below(grammar, chart, st)
+        elif st.dot_pos == RB:
+            _handle_right_below(grammar, chart, st)
+        else:
+            _handle_right_above(grammar, chart, st)
+        k += 1
 
+    return [st for tree in grammar.init_by_symbol[grammar.start_symbol]
+        for st in chart.ending(tree, (), RA, len(tokens) - 1) if st.i == 0]
 
+def recognize(grammar, tokens):
+    return bool(parse(grammar, tokens))
 
 
+if __name__ == "__main__":
+    S = NonTerminal("S")
+    t1 = S-["e"]
+    t2 = S-["a", S-["c", ~S, "d"], "b"]
+    g = TAG([t1, t2], S)
+
+    for text in ["e", "acedb", "aacceddbb", "acacedbdb", "aabbeccdd", "aced"]:
+        print "%-12s %s" % (text, recognize(g, text))
@@ -23,24 +23,21 @@ g = TIG(init_trees = [
     aux_trees = []
 )
 
-#===================================================================================================
-# Let's print a couple of trees
-#===================================================================================================
-for i, t in enumerate(parse(g, T, "a + a + a")):
-    print "[%d]" % (i + 1,)
-    t.show()
-    print
-
-#===================================================================================================
-# Now let's see we really generate the Catalan sequence (first 10 numbers)
-#===================================================================================================
-produced = [len(parse(g, T, " + ".join("a" * i).split())) 
-    for i in range(1, 11)] 
-
-print "The sequence we got is ", produced
-assert produced == [1, 1, 2, 5, 14, 42, 132, 429, 1430, 4862]
-print "Hooray!"
-
-
-
-
+if __name__ == "__main__":
+    #===================================================================================================
+    # Let's print a couple of trees
+    #===================================================================================================
+    for i, t in enumerate(parse(g, T, "a + a + a")):
+        print "[%d]" % (i + 1,)
+        t.show()
+        print
+
+    #===================================================================================================
+    # Now let's see we really generate the Catalan sequence (first 10 numbers)
+    #===================================================================================================
+    produced = [len(parse(g, T, " + ".join("a" * i).split())) 
+        for i in range(1, 11)] 
+
+    print "The sequence we got is ", produced
+    assert produced == [1, 1, 2, 5, 14, 42, 132, 429, 1430, 4862]
+    print "Hooray!"
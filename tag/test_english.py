@@ -100,13 +100,14 @@ sentences = [
     "john saw the boy with the glasses and the telescope",
 ]
 
-for text in sentences:
-    print "==============================================================="
-    print text
-    print "==============================================================="
-    trees = parse(g, S, text.split())
-    for i, t in enumerate(trees):
-        print "(%d)" % (i + 1,)
-        t.show()
-        print
+if __name__ == "__main__":
+    for text in sentences:
+        print "==============================================================="
+        print text
+        print "==============================================================="
+        trees = parse(g, S, text.split())
+        for i, t in enumerate(trees):
+            print "(%d)" % (i + 1,)
+            t.show()
+            print
 
@@ -0,0 +1,117 @@
+import random
+from tig5 import NonTerminal, Foot, Tree, TIG, GrammarError, ParsingError, parse
+from tig5 import _fill_chart, _fill_chart_parallel
+import test_english
+import test_catalan
+
+#===================================================================================================
+# parse_parallel() must accept the same sentences as parse(), with the same number of derivations
+# for each matching state, including for grammars with empty (epsilon) leaves, which combine states
+# on empty spans with one another
+#===================================================================================================
+A = NonTerminal("A")
+B = NonTerminal("B")
+C = NonTerminal("C")
+
+def derivations(fill, grammar, start, tokens):
+    try:
+        chart, matches, stats = fill(grammar, start, tokens)
+    except ParsingError:
+        return None
+    return sorted((str(st.tree), chart.count_derivations(st)) for st in matches)
+
+def sequential(grammar, start, tokens):
+    return _fill_chart(grammar, start, tokens, False, None)
+
+def parallel(grammar, start, tokens):
+    return _fill_chart_parallel(grammar, start, tokens, 1, False, None)
+
+def check(grammar, start, tokens):
+    expected = derivations(sequential, grammar, start, tokens)
+    assert derivations(parallel, grammar, start, tokens) == expected, (tokens, expected)
+    return expected
+
+def random_tree(rand, depth, root = None):
+    children = []
+    for i in range(rand.randint(1, 3)):
+        r = rand.random()
+        if depth > 0 and r < 0.25:
+            children.append(random_tree(rand, depth - 1))
+        elif r < 0.45:
+            children.append(rand.choice([A, B, C]))
+        elif r < 0.6:
+            children.append("")
+        else:
+            children.append(rand.choice("ab"))
+    return Tree(root or rand.choice([A, B, C]), children)
+
+def random_grammar(rand):
+    init_trees = [random_tree(rand, 2) for i in range(rand.randint(1, 4))]
+    aux_trees = []
+    for i in range(rand.randint(0, 2)):
+        t = random_tree(rand, 1)
+        foot = [Foot(t.root)]
+        children = foot + list(t.children) if rand.random() < 0.5 else list(t.children) + foot
+        aux_trees.append(Tree(t.root, children))
+    return TIG(init_trees, aux_trees)
+
+if __name__ == "__main__":
+    #===================================================================================================
+    # Empty leaves
+    #===================================================================================================
+    g = TIG(init_trees = [A(B(""), C(""), "a")], aux_trees = [])
+    assert check(g, A, ["a"]) == [("A(B(''), C(''), 'a')", 1)]
+    g = TIG(init_trees = [A(B, C(""), "a"), B(C(""), "b")], aux_trees = [B(Foot(B), "", "c")])
+    assert check(g, A, ["b", "c", "a"]) == [("A(B, C(''), 'a')", 1)]
+
+    #===================================================================================================
+    # A subtree of an elementary tree is substituted where it was predicted (by rule (9)), and only 
+    # there; e.g., the V of V(V, Conj("and"), Foot(V)) by the V("kissed") of VP(V("kissed"), NP)
+    #===================================================================================================
+    g = TIG(init_trees = [A(B("a"), C("b")), A(B("a"), C)], aux_trees = [])
+    assert check(g, A, ["a", "b"]) == [("A(B('a'), C('b'))", 1), ("A(B('a'), C)", 1)]
+    g = TIG(init_trees = [A(B("a"), C("b")), A(C, "c")], aux_trees = [])
+    assert check(g, A, ["b", "c"]) is None
+    assert check(test_english.g, test_english.S, "john kissed and hugged mary".split())
+    # including where it was predicted by a tree whose anchors are missing (see TIG.select)
+    g = TIG(init_trees = [A(C, "a"), C(A("b"))], aux_trees = [])
+    assert check(g, A, ["b"]) == [("A('b')", 1)]
+
+    #===================================================================================================
+    # A tree's type belongs to the grammar, so an initial tree equal to a tree derived earlier (and
+    # shared with it) is still an initial tree
+    #===================================================================================================
+    derived = TIG(init_trees = [B(C), C("a")], aux_trees = [])
+    trees = parse(derived, B, ["a"])
+    g = TIG(init_trees = [A(B), A(C(B("")), B), B(C("a"))], aux_trees = [])
+    assert check(g, A, ["a"]) == [("A(B)", 1), ("A(C(B('')), B)", 1)]
+
+    #===================================================================================================
+    # The demo grammars
+    #===================================================================================================
+    for text in test_english.sentences:
+        assert check(test_english.g, test_english.S, text.split())
+    for i in range(1, 8):
+        assert check(test_catalan.g, test_catalan.T, " + ".join("a" * i).split())
+
+    #===================================================================================================
+    # Random grammars; those that derive a sentence in infinitely many ways (e.g., by adjoining
+    # A(Foot(A), "") over and over) are skipped
+    #===================================================================================================
+    checked = 0
+    for seed in range(1000):
+        rand = random.Random(seed)
+        try:
+            g = random_grammar(rand)
+        except GrammarError:
+            continue
+        for n in range(4):
+            tokens = [rand.choice("ab") for i in range(n)]
+            try:
+                expected = derivations(sequential, g, A, tokens)
+            except AssertionError:
+                continue
+            assert derivations(parallel, g, A, tokens) == expected, (seed, tokens, expected)
+            checked += 1
+    print "parse_parallel agrees with parse on %d random grammars and sentences" % (checked,)
+    print "Hooray!"
@@ -6,6 +6,17 @@
 #==============================================================================
 #==============================================================================
 
+import os
+import array
+import heapq
+import cPickle
+import weakref
+import itertools
+import multiprocessing
+import collections
+import hashlib
+import resource
+
 # Whether or not to use unicode (some terminals choke on this)
 USE_UNICODE = True
 if USE_UNICODE:
@@ -33,12 +44,20 @@ class ParsingError(Exception):
 class NonTerminal(object):
     """
     Represents a non-terminal in the grammar; there's no need for a class to 
-    represent terminals, as we just use strings for that
+    represent terminals, as we just use strings for that. Non-terminals 
+    compare by name, so a grammar loaded from disk works with the symbols of 
+    the code that built it
     """
     def __init__(self, name):
         self.name = name
     def __str__(self):
         return self.name
+    def __eq__(self, other):
+        return isinstance(other, NonTerminal) and self.name == other.name
+    def __ne__(self, other):
+        return not (self == other)
+    def __hash__(self):
+        return hash(self.name)
     def __call__(self, *children):
         return Tree(self, children)
 
@@ -51,96 +70,108 @@ class Foot(object):
         self.nonterminal = nonterminal
     def __str__(self):
         return "%s*" % (self.nonterminal,)
+    def __eq__(self, other):
+        return isinstance(other, Foot) and self.nonterminal == other.nonterminal
+    def __ne__(self, other):
+        return not (self == other)
+    def __hash__(self):
+        return hash((Foot, self.nonterminal))
 
 class Tree(object):
     """
     Represents a grammar tree. This could be either an initial, left-aux or
     right-aux tree, or a deviation tree (we reuse this class for this purpose 
-    too). Note that trees compare by *value*, not identity, and are 
-    immutable once created.
+    too). Trees are immutable once created, and they are interned 
+    (hash-consed): creating a tree equal to one that already exists returns 
+    the existing one, so equal trees are the same object, and trees compare 
+    and hash by identity in O(1), while derived trees share their subtrees.
+    
+    Since equal trees are shared, a tree doesn't know its type (initial, 
+    left-aux or right-aux); that's up to the grammar holding it (see 
+    TIG.get_tree_type)
     """
     INIT_TREE = 0
     LEFT_AUX = 1
     RIGHT_AUX = 2
-    DERIVATION_TREE = 3
     
-    def __init__(self, root, children, type = INIT_TREE):
-        self.root = root
-        self.children = tuple(children)
-        self.type = type
-        self._hash = None
-        self._path = NotImplemented
-
+    # (root, children) -> tree, for all live trees
+    _interned = weakref.WeakValueDictionary()
+    
+    def __new__(cls, root, children):
+        children = tuple(children)
+        key = (root, children)
+        tree = cls._interned.get(key)
+        if tree is None:
+            tree = object.__new__(cls)
+            tree.root = root
+            tree.children = children
+            tree._path = NotImplemented
+            cls._interned[key] = tree
+        return tree
+    
     def __str__(self):
         return "%s(%s)" % (self.root, 
             ", ".join((repr(c) if isinstance(c, str) else str(c)) 
                 for c in self.children))
-    def __eq__(self, other):
-        if not isinstance(other, Tree):
-            return False
-        return (self.root, self.children) == (other.root, other.children)
-    def __ne__(self, other):
-        return not (self == other)
-    def __hash__(self):
-        if self._hash is None:
-            self._hash = hash((self.root, self.children))
-        return self._hash
+    def __reduce__(self):
+        # unpickled trees are interned as well
+        return (Tree, (self.root, self.children))
     
     def _path_to_foot(self):
         for i, child in enumerate(self.children):
             if isinstance(child, Foot):
-                return [i]
+                return (i,)
             elif isinstance(child, Tree):
                 p = child._path_to_foot()
                 if p:
-                    return [i] + p
+                    return (i,) + p
         return None
     
     def path_to_foot(self):
         """
-        Returns the path from the root of this tree to the foot, or None
-        if no foot exists; this is similar to Gorn tree-addresses
+        Returns the path (a tuple) from the root of this tree to the foot, or 
+        None if no foot exists; this is similar to Gorn tree-addresses
         """
         if self._path is NotImplemented:
             self._path = self._path_to_foot()
         return self._path
     
-    def _substitute(self, i, child):
+    def _replace(self, path, subtree):
+        # path-copies the tree, replacing the node at the (non-empty) path
         children2 = list(self.children)
-        children2[i] = child
-        return Tree(self.root, children2, self.DERIVATION_TREE)
+        if len(path) == 1:
+            children2[path[0]] = subtree
+        else:
+            children2[path[0]] = children2[path[0]]._replace(path[1:], subtree)
+        return Tree(self.root, children2)
     
-    def deep_substitute(self, i, child):
+    def deep_substitute(self, i, child, path = ()):
         """
-        Returns a copy of this tree, in which the i'th child is replaced by 
-        the given subtree. If this tree contains a foot, substitution occurs 
-        in the i'th child of the parent of the foot instead
+        Returns a copy of this tree, in which the i'th child of the node at 
+        the given path is replaced by the given subtree. Only the nodes along
+        the path are copied, the rest are shared
         """
-        path = self.path_to_foot()
-        if not path:
-            return self._substitute(i, child)
-        return self._deep_substitute(path[:-1], i, child)
-    
-    def _deep_substitute(self, path, i, child):
-        if not path:
-            return self._substitute(i, child)
-        children2 = list(self.children)
-        children2[path[0]]._deep_substitute(path[1:], i, child)
-        return Tree(self.root, children2, self.DERIVATION_TREE)
+        return self._replace(path + (i,), child)
     
     def substitute_foot(self, subtree):
         """
         Returns a copy of this tree, in which the foot (should it exist) is 
         replaced by the given subtree
         """
-        children2 = list(self.children)
-        for i, child in enumerate(children2):
-            if isinstance(child, Foot):
-                children2[i] = subtree
-                break
-            elif isinstance(child, Tree):
-                children2[i] = child.substitute_foot(subtree)
-        return Tree(self.root, children2, self.DERIVATION_TREE)
+        path = self.path_to_foot()
+        if not path:
+            return self
+        return self._replace(path, subtree)
+    
+    def subtrees(self):
+        """
+        returns an iterator over the proper subtrees of this tree, in preorder
+        """
+        for c in self.children:
+            if isinstance(c, Tree):
+                yield c
+                for t in c.subtrees():
+                    yield t
     
     def leaves(self):
         """
@@ -171,21 +202,23 @@ class TIG(object):
     Represents a TIG grammar instance; it basically holds the initial and
     auxiliary trees that make up the grammar. Upon creation, this class 
     verifies the given trees indeed form a valid TIG.  
+    
+    The trees are also indexed by their anchors (their terminal leaves), and
+    by the trees they predict, so that select() can quickly pick the trees 
+    that may take part in parsing a given sentence. The type of each tree is
+    kept by the grammar, not by the (shared) tree.
     """
     def __init__(self, init_trees, aux_trees):
-        self.init_trees_by_symbol = {}
+        self._init_indexes()
+        entries = []
         for t in init_trees:
             leaves = list(t.leaves())
             if not leaves:
                 raise GrammarError("Initial trees must not be empty", t)
             if any(isinstance(n, Foot) for n in leaves):
                 raise GrammarError("Initial trees cannot contain foot leaves")
-            if t.root not in self.init_trees_by_symbol:
-                self.init_trees_by_symbol[t.root] = []
-            self.init_trees_by_symbol[t.root].append(t)
+            entries.append((t, leaves, Tree.INIT_TREE))
 
-        self.left_aux_trees_by_symbol = {}
-        self.right_aux_trees_by_symbol = {}
         for t in aux_trees:
             leaves = list(t.leaves())
             if not leaves:
@@ -195,23 +228,169 @@ class TIG(object):
                     "foot", t)
             if isinstance(leaves[-1], Foot):
                 foot = leaves[-1]
-                coll = self.left_aux_trees_by_symbol
-                t.type = Tree.LEFT_AUX
+                type = Tree.LEFT_AUX
             elif isinstance(leaves[0], Foot):
                 foot = leaves[0]
-                coll = self.right_aux_trees_by_symbol
-                t.type = Tree.RIGHT_AUX
+                type = Tree.RIGHT_AUX
             else:
                 raise GrammarError("Auxiliary trees must contain either a "
                     "leftmost or a rightmost foot", t)
             if foot.nonterminal != t.root:
                 raise GrammarError("The foot of an auxiliary tree must be "
                     "of the same nonterminal as the root", t)
-            
-            if t.root not in coll:
-                coll[t.root] = []
-            coll[t.root].append(t)
+            entries.append((t, leaves, type))
+        
+        for ordinal, (t, leaves, type) in enumerate(entries):
+            anchors = [n for n in _leading_leaves(t) if isinstance(n, basestring) 
+                and n]
+            self._add((ordinal, t, frozenset(anchors), 
+                anchors[0] if anchors else None, type))
+        self._index_predictions()
+    
+    def _init_indexes(self):
+        self._hash = None
+        self.init_trees_by_symbol = {}
+        self.left_aux_trees_by_symbol = {}
+        self.right_aux_trees_by_symbol = {}
+        self._aux_types = {}
+        # first anchor -> [(ordinal, tree, anchors, first anchor, type), ...]
+        self._anchored = {}
+        self._unanchored = []
+        # see _index_predictions
+        self._groups = {}
+        self._group_of = {}
+        self._head_predictors = {}
+        self._later_predictors = {}
+    
+    def _add(self, entry):
+        ordinal, t, anchors, first, type = entry
+        if type == Tree.LEFT_AUX:
+            coll = self.left_aux_trees_by_symbol
+            self._aux_types[t] = type
+        elif type == Tree.RIGHT_AUX:
+            coll = self.right_aux_trees_by_symbol
+            self._aux_types[t] = type
+        else:
+            coll = self.init_trees_by_symbol
+        if t.root not in coll:
+            coll[t.root] = []
+        coll[t.root].append(t)
+        if first is None:
+            self._unanchored.append(entry)
+        elif first in self._anchored:
+            self._anchored[first].append(entry)
+        else:
+            self._anchored[first] = [entry]
     
+    def _index_predictions(self):
+        # A tree some of whose anchors are missing from a sentence may still
+        # be predicted, and predict other trees (by rules (2) and (7)), whose
+        # subtrees may be substituted where they were predicted. select() 
+        # keeps such a tree if it predicts a tree that was kept, unless the
+        # trees predicted along with it (of the same type and root) make the
+        # same predictions at its start (they're grouped by them), and one 
+        # of them was kept. The predictions are indexed by the type and root 
+        # of the predicted trees: (LEFT_AUX, root) for rule (2), and 
+        # (INIT_TREE, non-terminal) for rule (7)
+        for entries in [self._unanchored] + self._anchored.values():
+            for entry in entries:
+                ordinal, t, anchors, first, type = entry
+                head, later = self._predictions(t, anchors)
+                key = (type, t.root, frozenset(head))
+                _append(self._groups, key, entry)
+                self._group_of[ordinal] = key
+                if not anchors:
+                    continue
+                for prediction in head:
+                    self._head_predictors.setdefault(prediction, set()).add(key)
+                for prediction in later:
+                    _append(self._later_predictors, prediction, entry)
+        for entries in self._groups.values():
+            entries.sort()
+    
+    @staticmethod
+    def _predictions(tree, anchors):
+        # the (type, root) of the trees predicted by the states of the tree 
+        # that precede its last leading anchor (see _leading_leaves), as a 
+        # set of those predicted at its start, and a set of the others
+        stop = -1
+        for i, n in enumerate(_leading_leaves(tree)):
+            if isinstance(n, basestring) and n in anchors:
+                stop = i
+        head = set()
+        later = set()
+        predictions = head
+        i = 0
+        for n in _walk(tree):
+            if isinstance(n, Tree):
+                predictions.add((Tree.LEFT_AUX, n.root))
+                continue
+            if i == stop:
+                break
+            if isinstance(n, NonTerminal):
+                predictions.add((Tree.INIT_TREE, n))
+            predictions = later
+            i += 1
+        return head, later
+    
+    def select(self, tokens):
+        """
+        Returns a TIG holding only the trees that may take part in parsing the
+        given tokens, so that parsing with it gives the same results as with
+        the whole grammar. These are the trees whose leading anchors (those up
+        to the end of their subtree that ends first) appear among the tokens,
+        the trees that have no leading anchors, and (see _index_predictions)
+        the trees that predict other selected trees. Only the trees anchored 
+        by one of the tokens, and the trees they're predicted by, are looked 
+        at, so for a lexicalized grammar this takes time proportional to the 
+        selected trees, not to the whole grammar
+        """
+        tokens = set(tokens)
+        entries = list(self._unanchored)
+        for tok in tokens:
+            entries.extend(e for e in self._anchored.get(tok, ()) 
+                if e[2] <= tokens)
+        selected = dict((e[0], e) for e in entries)
+        covered = set(self._group_of[ordinal] for ordinal in selected)
+        predicted = set()
+        while entries:
+            ordinal, t, anchors, first, type = entries.pop()
+            if (type, t.root) in predicted:
+                continue
+            predicted.add((type, t.root))
+            for e in self._later_predictors.get((type, t.root), ()):
+                if e[0] not in selected:
+                    selected[e[0]] = e
+                    covered.add(self._group_of[e[0]])
+                    entries.append(e)
+            for key in self._head_predictors.get((type, t.root), ()):
+                if key not in covered:
+                    covered.add(key)
+                    e = self._groups[key][0]
+                    selected[e[0]] = e
+                    entries.append(e)
+        # keep the order of the grammar, so charts come out the same
+        grammar = TIG.__new__(TIG)
+        grammar._init_indexes()
+        for e in sorted(selected.values()):
+            grammar._add(e)
+        grammar._index_predictions()
+        return grammar
+    
+    def num_trees(self):
+        """
+        Returns the number of elementary trees in the grammar
+        """
+        return len(self._unanchored) + sum(len(entries) 
+            for entries in self._anchored.values())
+    
+    def get_tree_type(self, tree):
+        """
+        Returns the type of the given tree in this grammar: Tree.LEFT_AUX or
+        Tree.RIGHT_AUX for its auxiliary trees, and Tree.INIT_TREE for any 
+        other tree (initial trees, and subtrees of elementary trees)
+        """
+        return self._aux_types.get(tree, Tree.INIT_TREE)
     def get_init_trees_for(self, symbol):
         """
         Returns a (possibly empty) list of initial trees whose roots are the 
@@ -230,6 +409,79 @@ class TIG(object):
         are the given non-terminal
         """
         return self.right_aux_trees_by_symbol.get(symbol, ())
+    
+    def content_hash(self):
+        """
+        Returns a hash identifying the grammar by its trees (regardless of 
+        their order); it is computed once
+        """
+        if self._hash is not None:
+            return self._hash
+        trees = []
+        for kind, coll in (("init", self.init_trees_by_symbol), 
+                ("left", self.left_aux_trees_by_symbol), 
+                ("right", self.right_aux_trees_by_symbol)):
+            for t in (t for ts in coll.values() for t in ts):
+                trees.append("%s %s" % (kind, t))
+        h = hashlib.sha1()
+        for t in sorted(trees):
+            h.update(t.encode("utf8") if isinstance(t, unicode) else t)
+            h.update("\n")
+        self._hash = h.hexdigest()
+        return self._hash
+
+def _walk(tree):
+    # yields the tree, and its subtrees and leaves in preorder
+    yield tree
+    for c in tree.children:
+        if isinstance(c, Tree):
+            for n in _walk(c):
+                yield n
+        else:
+            yield c
+
+def _leading_leaves(tree):
+    # the leaves of the tree up to the end of its first subtree (in preorder)
+    # whose children are all leaves, which is the subtree that ends first
+    leaves = []
+    for c in tree.children:
+        if isinstance(c, Tree):
+            return leaves + _leading_leaves(c)
+        leaves.append(c)
+    return leaves
+
+#==============================================================================
+# Grammar persistence
+#==============================================================================
+GRAMMAR_MAGIC = "tig5-grammar"
+GRAMMAR_FORMAT = 9
+
+def save_grammar(grammar, path):
+    """
+    Saves a TIG to the given file: a small header (format version and content 
+    hash), followed by the pickled grammar. The file is written under a 
+    temporary name and renamed, so readers never see half of it
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        cPickle.dump((GRAMMAR_MAGIC, GRAMMAR_FORMAT, grammar.content_hash()), f, 2)
+        cPickle.dump(grammar, f, 2)
+    os.rename(tmp, path)
+
+def load_grammar(path, expected_hash = None):
+    """
+    Loads a TIG saved by save_grammar(), skipping the validation done by 
+    TIG.__init__ (it was validated when it was built). Raises GrammarError 
+    if the file is of another format version, or (when expected_hash is 
+    given) does not hold the expected grammar
+    """
+    with open(path, "rb") as f:
+        header = cPickle.load(f)
+        if not isinstance(header, tuple) or header[:2] != (GRAMMAR_MAGIC, GRAMMAR_FORMAT):
+            raise GrammarError("Not a grammar of format %d" % (GRAMMAR_FORMAT,), path)
+        if expected_hash is not None and header[2] != expected_hash:
+            raise GrammarError("Grammar hash mismatch", path)
+        return cPickle.load(f)
 
 #==============================================================================
 # Chart and Chart States
@@ -246,6 +498,14 @@ class State(object):
         self.j = j
         self.index = None
         self._hash = None
+    def __getstate__(self):
+        # the hash depends on the identity of the (interned) tree, and the 
+        # index on the chart, so neither is pickled
+        return (self.tree, self.dot, self.i, self.j)
+    def __setstate__(self, state):
+        self.tree, self.dot, self.i, self.j = state
+        self.index = None
+        self._hash = None
     def __str__(self):
         prod = ["%s%s" % (c, SYM_DOWN_ARROW) 
             if isinstance(c, NonTerminal) else str(c) 
@@ -277,48 +537,206 @@ class State(object):
             return None
         return self.tree.children[self.dot]
 
-class ChartItem(object):
+class ParseStats(object):
     """
-    A helper object, associated with each chart state, that holds the reasons
-    for adding this state and the state's subtree builders
+    Counts the work done by the parser, to find out which sentences (and which
+    trees of the grammar) make the chart blow up. Every state added to the
+    chart is counted as a prediction (rules 1, 2, 7, 9, 11), a scan (rules 4,
+    5, 6) or a completion (rules 3, 8, 10, 12); with per_rule, these counts
+    are also kept per tree of the grammar
     """
-    UNPROCESSED = 1
-    PROCESSING = 2
-    PROCESSED = 3
-    
-    def __init__(self, reason, subtreefunc):
-        self.reasons = {reason}
-        self.subtreefuncs = {subtreefunc}
-        self.subtrees = set()
-        # `stage` serves as a marker for get_subtrees()
-        self.stage = self.UNPROCESSED
+    EVENTS = ("predictions", "scans", "completions")
+    RULE_EVENTS = {1 : "predictions", 2 : "predictions", 7 : "predictions", 
+        9 : "predictions", 11 : "predictions", 4 : "scans", 5 : "scans", 
+        6 : "scans", 3 : "completions", 8 : "completions", 10 : "completions", 
+        12 : "completions"}
     
-    def add(self, reason, subtreefunc):
+    def __init__(self, per_rule = False):
+        self.states = 0         # states created, including duplicates
+        self.duplicates = 0     # states rejected as already in the chart
+        self.predictions = 0
+        self.scans = 0
+        self.completions = 0
+        self.column_sizes = []  # number of states ending at each position
+        self.peak_memory = 0    # peak RSS of the process, in KB
+        # str(tree) -> event -> states created
+        self.rules = {} if per_rule else None
+    def __repr__(self):
+        return "ParseStats(%s)" % (", ".join("%s=%r" % (k, v) 
+            for k, v in sorted(self.as_dict().items()) if k != "rules"),)
+    def as_dict(self):
+        """
+        Returns the statistics as a plain dict
+        """
+        return dict((k, getattr(self, k)) for k in ("states", "duplicates", 
+            "predictions", "scans", "completions", "column_sizes", 
+            "peak_memory", "rules"))
+    def record(self, state, reason, added):
         """
-        Adds a reason and a subtree-builder to this chart item
+        Counts a state that was committed to the chart for the given reason
+        (a tuple whose first element is the number of the rule)
         """
-        self.reasons.add(reason)
-        self.subtreefuncs.add(subtreefunc)
+        self.states += 1
+        if not added:
+            self.duplicates += 1
+        event = self.RULE_EVENTS[reason[0]]
+        setattr(self, event, getattr(self, event) + 1)
+        if self.rules is not None:
+            # str(tree) is only worth its cost when the trees are counted
+            counters = self.rules.setdefault(str(state.tree), 
+                dict.fromkeys(self.EVENTS, 0))
+            counters[event] += 1
+    def finish(self, chart, num_tokens):
+        """
+        Collects the per-position sizes of the final chart
+        """
+        self.column_sizes = [0] * (num_tokens + 1)
+        for st in chart:
+            self.column_sizes[st.j] += 1
+        self.peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    def hot_rules(self, count = 10):
+        """
+        Returns the (tree, counters) pairs of the trees that created the most
+        states
+        """
+        if not self.rules:
+            return []
+        return sorted(self.rules.items(), 
+            key = lambda item: -sum(item[1].values()))[:count]
 
 class Chart(object):
     """
     Represents the parser chart. It comprises of states (without duplicates),
-    but it preserves the ordering relations for debugging purposes. With each
-    state we associates a ChartItem, to hold some extra info. 
+    in the order they were committed, which it keeps compactly: each state is
+    a row of parallel integer arrays (tree id, dot, i, j), and each of the 
+    state's derivations is a row of (subtree-builder, operand, operand, next
+    derivation of the state), whose operands are the indexes of the states 
+    it was built of (or the id of the tree, for BUILD_CONST). State objects 
+    are only made on demand, when the chart is indexed, iterated or looked 
+    up (the get_XXX() lookups), for show() and for tree extraction, and the 
+    chart doesn't hold on to them.
     States are add()ed to the chart, but they don't actually become part of 
     it until commit()ted. This prevents some issues with dictionary iteration.
+    If a ParseStats is given, every committed state is recorded in it.
+    
+    A reason is a tuple of the rule number and the indexes of the states the 
+    rule was applied to; reasons are only kept (and formatted by show()) if 
+    debug is True.
+    
+    Once the parser has processed a state, it is mark_processed(), which adds 
+    it to the lookup indexes the combination rules use: completed states by 
+    (start, root, tree type) and by (start, tree), and, for combining a newly 
+    completed state with the states that wait for it, completed states by 
+    (end, root), states at dot 0 by (end, root) and incomplete states by 
+    (end, next child). The types of the trees are those of the given grammar.
     """
     
-    def __init__(self):
-        self._states = {}
-        self._ordered_states = []
-        self._changes = []
+    LAZY_CACHE_LIMIT = 64
+    
+    def __init__(self, grammar, stats = None, debug = False):
+        self.grammar = grammar
+        self._trees = []                # tree id -> tree
+        self._tree_ids = {}             # tree -> tree id
+        self._keys = {}                 # packed (tree id, dot, i, j) -> index
+        self._tree = array.array("i")
+        self._dot = array.array("i")
+        self._start = array.array("i")
+        self._end = array.array("i")
+        # index -> first and last derivation, and whether it was predicted 
+        # (has a BUILD_CONST one), and derivation -> builder, operands and 
+        # next derivation of the same state (or -1)
+        self._first = array.array("i")
+        self._last = array.array("i")
+        self._predicted = array.array("b")
+        self._func = array.array("b")
+        self._left = array.array("i")
+        self._right = array.array("i")
+        self._next = array.array("i")
+        self._reasons = {} if debug else None
+        self._subtrees = {}
+        self._counts = {}
+        self._changes = collections.deque()
+        self._completed = {}
+        self._completed_trees = {}
+        self._completed_ending = {}
+        self._adjoinable = {}
+        self._waiting = {}
+        self.stats = stats
+        self.debug = debug
     def __iter__(self):
-        return iter(self._ordered_states)
+        return itertools.imap(self.__getitem__, xrange(len(self)))
     def __len__(self):
-        return len(self._ordered_states)
+        return len(self._tree)
     def __getitem__(self, index):
-        return self._ordered_states[index]
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        st = State(self._trees[self._tree[index]], self._dot[index], 
+            self._start[index], self._end[index])
+        st.index = index
+        return st
+    
+    def _tree_id(self, tree):
+        tid = self._tree_ids.get(tree)
+        if tid is None:
+            tid = self._tree_ids[tree] = len(self._trees)
+            self._trees.append(tree)
+        return tid
+    @staticmethod
+    def _key(tid, dot, i, j):
+        # a state as a single integer (for trees of fewer than 2**16 children,
+        # and sentences of fewer than 2**32 tokens)
+        return (((((tid << 16) | dot) << 32) | i) << 32) | j
+    def _index(self, st):
+        return st.index if st.index is not None else self.index_of(st)
+    
+    def mark_processed(self, st):
+        """
+        Adds a committed state to the lookup indexes; from now on, the get_XXX()
+        lookups will return it
+        """
+        if st.is_complete():
+            _append_index(self._completed, (st.i, st.tree.root, 
+                self.grammar.get_tree_type(st.tree)), st.index)
+            _append_index(self._completed_trees, (st.i, st.tree), st.index)
+            _append_index(self._completed_ending, (st.j, st.tree.root), st.index)
+        else:
+            _append_index(self._waiting, (st.j, st.next()), st.index)
+        if st.dot == 0:
+            _append_index(self._adjoinable, (st.j, st.tree.root), st.index)
+    def get_completed(self, i, root, type):
+        """
+        Returns the processed complete states of trees of the given root and 
+        type, starting at position i
+        """
+        return self._states(self._completed.get((i, root, type), ()))
+    def get_completed_subtrees(self, i, tree):
+        """
+        Returns the processed complete states of the given tree, starting at 
+        position i
+        """
+        return self._states(self._completed_trees.get((i, tree), ()))
+    def get_completed_ending(self, j, root):
+        """
+        Returns the processed complete states of trees of the given root, 
+        ending at position j
+        """
+        return self._states(self._completed_ending.get((j, root), ()))
+    def get_adjoinable(self, j, root):
+        """
+        Returns the processed states of trees of the given root, whose dot is
+        at the start and that end at position j
+        """
+        return self._states(self._adjoinable.get((j, root), ()))
+    def get_waiting(self, j, prod):
+        """
+        Returns the processed states ending at position j, whose next child
+        is the given non-terminal or subtree
+        """
+        return self._states(self._waiting.get((j, prod), ()))
+    def _states(self, indexes):
+        return itertools.imap(self.__getitem__, indexes)
     
     def add(self, state, reason, subtreefunc = None, *args):
         """
@@ -326,10 +744,15 @@ class Chart(object):
         subtree-builder. Note that it's not actually added to the chart 
         until commit() is called
         """
-        if subtreefunc is None:
+        if subtreefunc is None or subtreefunc is BUILD_CONST:
+            left = self._tree_id(args[0] if args else state.tree)
+            right = -1
             subtreefunc = BUILD_CONST
-            args = (state.tree,)
-        self._changes.append((state, reason, (subtreefunc, args)))
+        else:
+            left = self._index(args[0])
+            right = self._index(args[1]) if len(args) > 1 else -1
+        self._changes.append((state, reason, _BUILDER_CODES[subtreefunc], 
+            left, right))
     
     def commit(self):
         """
@@ -337,89 +760,263 @@ class Chart(object):
         has grew, False otherwise
         """
         added = False
-        while self._changes:
-            st, reason, subtreefunc = self._changes.pop(0)
-            if st not in self._states:
-                st.index = len(self._ordered_states)
-                self._ordered_states.append(st)
-                self._states[st] = ChartItem(reason, subtreefunc)
+        changes = self._changes
+        keys = self._keys
+        while changes:
+            st, reason, func, left, right = changes.popleft()
+            tid = self._tree_id(st.tree)
+            key = self._key(tid, st.dot, st.i, st.j)
+            index = keys.get(key)
+            if self.stats is not None:
+                self.stats.record(st, reason, index is None)
+            if index is None:
+                index = keys[key] = len(self._tree)
+                self._tree.append(tid)
+                self._dot.append(st.dot)
+                self._start.append(st.i)
+                self._end.append(st.j)
+                self._first.append(-1)
+                self._last.append(-1)
+                self._predicted.append(0)
                 added = True
-            else:
-                self._states[st].add(reason, subtreefunc)
+            if self.debug:
+                self._reasons.setdefault(index, set()).add(reason)
+            # every pair of states is combined once, so only the BUILD_CONST
+            # derivations (of the state's own tree) may come more than once
+            if func == _BUILD_CONST_CODE:
+                if self._predicted[index]:
+                    continue
+                self._predicted[index] = 1
+            self._add_derivation(index, func, left, right)
 
         return added
-
+    
+    def _add_derivation(self, index, func, left, right):
+        d = len(self._func)
+        self._func.append(func)
+        self._left.append(left)
+        self._right.append(right)
+        self._next.append(-1)
+        if self._first[index] < 0:
+            self._first[index] = d
+        else:
+            self._next[self._last[index]] = d
+        self._last[index] = d
+    
+    def _derivations(self, index):
+        # yields (builder code, operand, operand) for each derivation of the
+        # state at the given index
+        d = self._first[index]
+        while d >= 0:
+            yield self._func[d], self._left[d], self._right[d]
+            d = self._next[d]
+    
+    def _subtreefuncs(self, index):
+        # yields (builder, args) for each derivation of the state at the 
+        # given index, with the operand states made on demand
+        for func, left, right in self._derivations(index):
+            if func == _BUILD_CONST_CODE:
+                yield BUILD_CONST, (self._trees[left],)
+            elif right < 0:
+                yield _BUILDERS[func], (self[left],)
+            else:
+                yield _BUILDERS[func], (self[left], self[right])
+    
+    def index_of(self, st):
+        """
+        Returns the index of the committed state equal to the given one
+        """
+        return self._keys[self._key(self._tree_ids[st.tree], st.dot, st.i, 
+            st.j)]
+    
     def get_subtrees(self, st):
         """
-        Gets the set of subtrees for a given state; this is memoized (cached) 
-        so once the subtrees of some state have been built, 
-        future calls are O(1)
-        """
-        item = self._states[st]
-        if item.stage == ChartItem.PROCESSED:
-            return item.subtrees
-        # make sure we're not accidentally reentrant
-        assert item.stage == ChartItem.UNPROCESSED
-        item.stage = ChartItem.PROCESSING
-        for func, args in item.subtreefuncs:
-            item.subtrees.update(func(self, *args))
-        item.stage = ChartItem.PROCESSED
-        return item.subtrees
+        Gets the set of subtrees for a given state; the subtrees are memoized 
+        (cached) so once the subtrees of some state have been built, they are
+        not built again
+        """
+        return set(t for t, path in self._get_subtrees(st))
+    
+    def _get_subtrees(self, st):
+        # returns the set of (subtree, path) pairs of the state, where path 
+        # leads to the node of the subtree whose children the state's dot 
+        # refers to: when auxiliary trees were left-adjoined to the state's 
+        # tree, this is where their foot was (see BUILD_AUX)
+        index = self._index(st)
+        if index in self._subtrees:
+            subtrees = self._subtrees[index]
+            # make sure we're not accidentally reentrant
+            assert subtrees is not None
+            return subtrees
+        self._subtrees[index] = None
+        subtrees = set()
+        for func, args in self._subtreefuncs(index):
+            subtrees.update(func(self._get_subtrees, *args))
+        self._subtrees[index] = subtrees
+        return subtrees
+    
+    def count_derivations(self, st):
+        """
+        Returns the number of derivations of the given state, i.e., the 
+        number of subtrees iter_subtrees() yields for it (memoized)
+        """
+        return self._count_derivations(self._index(st))
+    
+    def _count_derivations(self, index):
+        counts = self._counts
+        if index in counts:
+            total = counts[index]
+            # make sure we're not accidentally reentrant
+            assert total is not None
+            return total
+        counts[index] = None
+        total = 0
+        for func, left, right in self._derivations(index):
+            if func == _BUILD_CONST_CODE:
+                total += 1
+            elif right < 0:
+                total += self._count_derivations(left)
+            else:
+                total += (self._count_derivations(left) * 
+                    self._count_derivations(right))
+        counts[index] = total
+        return total
+    
+    def iter_subtrees(self, st, tokens, cache = None):
+        """
+        The lazy counterpart of get_subtrees(): yields the subtrees of the 
+        given state one at a time, building them as they are consumed. The 
+        subtrees of complete states are checked against the tokens they span,
+        so a subtree with the wrong leaves is dropped before any bigger tree 
+        is built on it. A subtree with several derivations is yielded once 
+        per derivation.
+        
+        States with at most LAZY_CACHE_LIMIT derivations have their subtrees 
+        built once and kept in the given cache dict (which is how bigger 
+        trees share them); the rest are rebuilt whenever they're iterated
+        """
+        if cache is None:
+            cache = {}
+        return (t for t, path in self._iter_subtrees(st, tokens, cache))
+    
+    def _iter_subtrees(self, st, tokens, cache):
+        # the lazy counterpart of _get_subtrees()
+        index = self._index(st)
+        if index in cache:
+            return iter(cache[index])
+        pairs = self._build_subtrees(st, index, tokens, cache)
+        if self._count_derivations(index) <= self.LAZY_CACHE_LIMIT:
+            pairs = cache[index] = list(pairs)
+            return iter(pairs)
+        return pairs
+    
+    def _build_subtrees(self, st, index, tokens, cache):
+        get = lambda st2: self._iter_subtrees(st2, tokens, cache)
+        span = tokens[st.i:st.j] if st.is_complete() else None
+        for func, args in self._subtreefuncs(index):
+            for t, path in func(get, *args):
+                if span is None or _spans(t, span):
+                    yield t, path
     
     def show(self, only_completed = False):
         """
         Print the chart in a human-readable manner
         """
-        for st in self._ordered_states:
+        for st in self:
             if only_completed and not st.is_complete():
                 continue
+            reasons = self._reasons.get(st.index, ()) if self.debug else ()
             print "%3d | %-40s | %s" % (st.index, st, 
-                " ; ".join(self._states[st].reasons))
+                " ; ".join(_format_reason(r) for r in sorted(reasons)))
         print "-" * 80
 
+def _format_reason(reason):
+    if len(reason) == 1:
+        return "[%d]" % reason
+    return "[%d]/%s" % (reason[0], ",".join(str(i) for i in reason[1:]))
+
+def _spans(tree, tokens):
+    # whether the leaves of the tree (but its foot) are the given tokens; 
+    # stops at the first leaf that differs
+    i = -1
+    for i, leaf in enumerate(n for n in tree.leaves() if not isinstance(n, Foot)):
+        if i >= len(tokens) or leaf != tokens[i]:
+            return False
+    return i + 1 == len(tokens)
+
+def _append(index, key, st):
+    if key in index:
+        index[key].append(st)
+    else:
+        index[key] = [st]
+
+def _append_index(index, key, i):
+    if key in index:
+        index[key].append(i)
+    else:
+        index[key] = array.array("i", (i,))
+
 #==============================================================================
 # Tree extraction combinators: 
 #
 # Whenever we add a new state to the chart, we associate with it a 
 # subtree-builder, which serves us later (we get_subtrees() is called). 
 # These builders combine partial trees to form bigger ones, according to 
-# the rules of the grammar 
+# the rules of the grammar. They are given the function that returns the 
+# (subtree, path) pairs of a state (see Chart._get_subtrees), and return 
+# iterators, so that the lazy extraction doesn't build cross products
 #==============================================================================
-def BUILD_CONST(chart, t):
-    return [t]
+def BUILD_CONST(get, t):
+    return [(t, ())]
+
+def BUILD_PROPAGATE(get, st):
+    return get(st)
 
-def BUILD_PROPAGATE(chart, st):
-    return chart.get_subtrees(st)
+def BUILD_SUBSTITUTION(get, st, st2):
+    return ((t1.deep_substitute(st.dot, t2, path1), path1) 
+        for t1, path1 in get(st) for t2, path2 in get(st2))
 
-def BUILD_SUBSTITUTION(chart, st, st2):
-    return [t1.deep_substitute(st.dot, t2) 
-        for t1 in chart.get_subtrees(st) for t2 in chart.get_subtrees(st2)]
+def BUILD_AUX(get, st, st2):
+    # the tree of st goes where the foot of the auxiliary tree was
+    return ((t2.substitute_foot(t1), t2.path_to_foot() + path1) 
+        for t1, path1 in get(st) for t2, path2 in get(st2))
 
-def BUILD_AUX(chart, st, st2):
-    return [t2.substitute_foot(t1) 
-        for t1 in chart.get_subtrees(st) for t2 in chart.get_subtrees(st2)]
+# the chart keeps the builders by their index in this tuple
+_BUILDERS = (BUILD_CONST, BUILD_PROPAGATE, BUILD_SUBSTITUTION, BUILD_AUX)
+_BUILDER_CODES = dict((func, code) for code, func in enumerate(_BUILDERS))
+_BUILD_CONST_CODE = _BUILDER_CODES[BUILD_CONST]
 
 #==============================================================================
 # Parser
+#
+# The chart doubles as the agenda: states are processed once each, in the 
+# order they were committed. Every binary rule combines a state waiting for 
+# something with a completed state, and each handler tries the new state in 
+# both roles, against the states processed before it (and itself), which it 
+# looks up in the indexes of the chart; this way every pair is combined 
+# exactly once, when the later of the two is processed
 #==============================================================================
 def handle_left_adj(grammar, chart, st):
     """
     handles the case of left-adjunction rules (2) and (3)
     """
-    if st.dot != 0:
-        return
-    
-    # (2)
-    for t in grammar.get_left_aux_trees_for(st.tree.root):
-        chart.add(State(t, 0, st.j, st.j), "[2]/%d" % (st.index,))
-    
-    # (3)
-    for st2 in chart:
-        if (st2.tree.type == Tree.LEFT_AUX and st.tree.root == st2.tree.root 
-                and st.j == st2.i and st2.is_complete()): 
+    if st.dot == 0:
+        # (2)
+        for t in grammar.get_left_aux_trees_for(st.tree.root):
+            chart.add(State(t, 0, st.j, st.j), (2, st.index))
+        
+        # (3)
+        for st2 in chart.get_completed(st.j, st.tree.root, Tree.LEFT_AUX):
             chart.add(State(st.tree, 0, st.i, st2.j), 
-                "[3]/%d,%d" % (st.index, st2.index), 
+                (3, st.index, st2.index), 
                 BUILD_AUX, st, st2)
+    
+    if grammar.get_tree_type(st.tree) == Tree.LEFT_AUX and st.is_complete():
+        # (3), with st as the adjoined tree
+        for st1 in chart.get_adjoinable(st.i, st.tree.root):
+            chart.add(State(st1.tree, 0, st1.i, st.j), 
+                (3, st1.index, st.index), 
+                BUILD_AUX, st1, st)
 
 def handle_scan(grammar, chart, st, token):
     """
@@ -430,17 +1027,17 @@ def handle_scan(grammar, chart, st, token):
         if prod == token:
             # (4)
             chart.add(State(st.tree, st.dot+1, st.i, st.j+1), 
-                "[4]/%d" % (st.index,), 
+                (4, st.index), 
                 BUILD_PROPAGATE, st)
         elif prod == "":
             # (5)
             chart.add(State(st.tree, st.dot+1, st.i, st.j), 
-                "[5]/%d" % (st.index,), 
+                (5, st.index), 
                 BUILD_PROPAGATE, st)
     elif isinstance(prod, Foot):
         # (6)
         chart.add(State(st.tree, st.dot+1, st.i, st.j), 
-            "[6]/%d" % (st.index,), 
+            (6, st.index), 
             BUILD_PROPAGATE, st)
 
 def handle_substitution(grammar, chart, st):
@@ -451,15 +1048,21 @@ def handle_substitution(grammar, chart, st):
     if isinstance(prod, NonTerminal):
         # (7)
         for t in grammar.get_init_trees_for(prod):
-            chart.add(State(t, 0, st.j, st.j), "[7]/%d" % (st.index,))
+            chart.add(State(t, 0, st.j, st.j), (7, st.index))
         
         # (8)
-        for st2 in chart:
-            if (st2.tree.root == prod and st.j == st2.i and st2.is_complete() 
-                    and st2.tree.type == Tree.INIT_TREE):
-                chart.add(State(st.tree, st.dot + 1, st.i, st2.j), 
-                    "[8]/%d,%d" % (st.index, st2.index), 
-                    BUILD_SUBSTITUTION, st, st2)
+        for st2 in chart.get_completed(st.j, prod, Tree.INIT_TREE):
+            chart.add(State(st.tree, st.dot + 1, st.i, st2.j), 
+                (8, st.index, st2.index), 
+                BUILD_SUBSTITUTION, st, st2)
+    
+    elif (grammar.get_tree_type(st.tree) == Tree.INIT_TREE and 
+            st.is_complete()):
+        # (8), with st as the substituted tree
+        for st1 in chart.get_waiting(st.i, st.tree.root):
+            chart.add(State(st1.tree, st1.dot + 1, st1.i, st.j), 
+                (8, st1.index, st.index), 
+                BUILD_SUBSTITUTION, st1, st)
  
 def handle_subtree_traversal(grammar, chart, st):
     """
@@ -468,14 +1071,20 @@ def handle_subtree_traversal(grammar, chart, st):
     prod = st.next()
     if isinstance(prod, Tree):
         # (9)
-        chart.add(State(prod, 0, st.j, st.j), "[9]/%d" % (st.index,)) 
+        chart.add(State(prod, 0, st.j, st.j), (9, st.index)) 
         
         # (10)
-        for st2 in chart:
-            if st2.tree == prod and st.j == st2.i and st2.is_complete():
-                chart.add(State(st.tree, st.dot + 1, st.i, st2.j), 
-                    "[10]/%d,%d" % (st.index, st2.index), 
-                    BUILD_SUBSTITUTION, st, st2)
+        for st2 in chart.get_completed_subtrees(st.j, prod):
+            chart.add(State(st.tree, st.dot + 1, st.i, st2.j), 
+                (10, st.index, st2.index), 
+                BUILD_SUBSTITUTION, st, st2)
+    
+    elif st.is_complete():
+        # (10), with st as the traversed subtree
+        for st1 in chart.get_waiting(st.i, st.tree):
+            chart.add(State(st1.tree, st1.dot + 1, st1.i, st.j), 
+                (10, st1.index, st.index), 
+                BUILD_SUBSTITUTION, st1, st)
 
 def handle_right_adj(grammar, chart, st):
     """
@@ -486,26 +1095,88 @@ def handle_right_adj(grammar, chart, st):
     
     # (11)
     for t in grammar.get_right_aux_trees_for(st.tree.root):
-        chart.add(State(t, 0, st.j, st.j), "[11]/%d" % (st.index,))
+        chart.add(State(t, 0, st.j, st.j), (11, st.index))
     
     # (12)
-    for st2 in chart:
-        if (st2.tree.type == Tree.RIGHT_AUX and st2.tree.root == st.tree.root 
-                and st.j == st2.i and st2.is_complete()):
-            chart.add(State(st.tree, len(st.tree.children), st.i, st2.j), 
-                "[12]/%d,%d" % (st.index, st2.index), 
-                BUILD_AUX, st, st2)
+    for st2 in chart.get_completed(st.j, st.tree.root, Tree.RIGHT_AUX):
+        chart.add(State(st.tree, len(st.tree.children), st.i, st2.j), 
+            (12, st.index, st2.index), 
+            BUILD_AUX, st, st2)
+    
+    if grammar.get_tree_type(st.tree) == Tree.RIGHT_AUX:
+        # (12), with st as the adjoined tree (the pair of st with itself was 
+        # combined above)
+        for st1 in chart.get_completed_ending(st.i, st.tree.root):
+            if st1 is not st:
+                chart.add(State(st1.tree, len(st1.tree.children), st1.i, st.j), 
+                    (12, st1.index, st.index), 
+                    BUILD_AUX, st1, st)
 
-def parse(grammar, start_symbol, tokens, debug = False):
+def _fill_chart(grammar, start_symbol, tokens, debug, stats):
+    """
+    Fills the chart for the given tokens and returns (chart, matching states,
+    stats), or raises ParsingError if there are no matching states
+    """
+    if stats is True:
+        stats = ParseStats()
+    grammar = grammar.select(tokens)
+    chart = Chart(grammar, stats, debug)
+    padded_tokens = [None] + tokens
+    
+    # (1)
+    for t in grammar.get_init_trees_for(start_symbol):
+        chart.add(State(t, 0, 0, 0), (1,))
+    
+    chart.commit()
+    
+    # main loop: run (2)-(12) on each state, which may commit new states
+    # to the end of the chart
+    k = 0
+    while k < len(chart):
+        st = chart[k]
+        chart.mark_processed(st)
+        handle_left_adj(grammar, chart, st)
+        tok = padded_tokens[st.j+1] if st.j+1 < len(padded_tokens) else None
+        handle_scan(grammar, chart, st, tok)
+        handle_substitution(grammar, chart, st)
+        handle_subtree_traversal(grammar, chart, st)
+        handle_right_adj(grammar, chart, st)
+        chart.commit()
+        k += 1
+    if stats is not None:
+        stats.finish(chart, len(tokens))
+
+    return chart, _get_matches(grammar, start_symbol, tokens, chart, debug, 
+        stats), stats
+
+def _get_matches(grammar, start_symbol, tokens, chart, debug, stats):
+    # (13)
+    matches = [st for st in chart if st.is_complete() and st.i == 0 
+        and st.j == len(tokens) and st.tree.root == start_symbol 
+        and grammar.get_tree_type(st.tree) == Tree.INIT_TREE]
+    if debug:
+        chart.show()
+        print "Matches:", [st.index for st in matches]
+        print
+
+    # fail if no matching state was found
+    if not matches:
+        ex = ParsingError("Grammar does not derive the given sequence")
+        ex.stats = stats
+        raise ex
+    return matches
+
+def parse(grammar, start_symbol, tokens, debug = False, stats = None, 
+        cache = None):
     """
     The actual parser: it takes a TIG grammar object, a start symbol 
     (NonTerminal) of that grammar, and a list of tokens, and returns 
     (hopefully) all possible parse trees for them.
     
     It works by first applying the initialization rule (1), 
-    then applying rules (2)-(12) for as long as the chart keeps changing, 
-    and once it's stable, it looks for matching states according to 
-    acceptance rule (13).
+    then applying rules (2)-(12) to every state of the chart, in order, 
+    until all states have been processed, and then it looks for matching 
+    states according to acceptance rule (13).
     
     It then takes all matching states (normally there should be only one),
     extracts the trees of each state, and returns a set of them.
@@ -515,50 +1186,509 @@ def parse(grammar, start_symbol, tokens, debug = False):
     
     The parsing is done in O(|G|^2 * n^3), as discussed in the paper, 
     and tree extraction is performed in amortized linear time, per each tree.
+    To get the trees one at a time, or only the best ones, see iter_parse()
+    and parse_k_best().
+    
+    If stats is given (True, or a ParseStats instance), returns a tuple of
+    (trees, stats) instead; on failure, the stats are attached to the 
+    ParsingError as its `stats` attribute.
+    
+    If cache (a ParseCache) is given, and neither debug nor stats are, 
+    tokens parsed before with the same grammar and start symbol are not 
+    parsed again.
     """
     if isinstance(tokens, str):
         tokens = tokens.split()
-    chart = Chart()
     tokens = list(tokens)
-    padded_tokens = [None] + tokens
-    
-    # (1)
-    for t in grammar.get_init_trees_for(start_symbol):
-        chart.add(State(t, 0, 0, 0), "[1]")
-    
-    # main loop: run (2)-(12) until no more changes occur
-    while True:
-        for st in chart:
-            handle_left_adj(grammar, chart, st)
-            tok = padded_tokens[st.j+1] if st.j+1 < len(padded_tokens) else None
-            handle_scan(grammar, chart, st, tok)
-            handle_substitution(grammar, chart, st)
-            handle_subtree_traversal(grammar, chart, st)
-            handle_right_adj(grammar, chart, st)
-        
-        if not chart.commit():
-            # no more changes, we're done
-            break
-
-    # (13)
-    matches = [st for st in chart if st.is_complete() and st.i == 0 
-        and st.j == len(tokens) and st.tree.root == start_symbol 
-        and st.tree.type == Tree.INIT_TREE]
-    if debug:
-        chart.show()
-        print "Matches:", [st.index for st in matches]
-        print
+    if cache is not None and not debug and stats is None:
+        return cache.parse(grammar, start_symbol, tokens)
+    chart, matches, stats = _fill_chart(grammar, start_symbol, tokens, debug, 
+        stats)
+    return _extract_trees(chart, matches, tokens, stats)
 
-    # fail if no matching state was found
-    if not matches:
-        raise ParsingError("Grammar does not derive the given sequence")
-    
+def _extract_trees(chart, matches, tokens, stats):
     # extract trees, drop ones that do not generate the correct token sequence
     trees = set(t for m in matches for t in chart.get_subtrees(m)
          if list(t.leaves()) == tokens)
     
     # and make sure we didn't lose all trees, for then it's our fault
     assert trees
+    if stats is not None:
+        return trees, stats
+    return trees
+
+def iter_parse(grammar, start_symbol, tokens, debug = False, stats = None):
+    """
+    Like parse(), but returns an iterator over the parse trees, which builds 
+    them one at a time, instead of building the set of all subtrees of every 
+    state on the way; its memory is bounded by the size of the chart rather 
+    than by the number of trees, which for ambiguous sentences is 
+    exponential. A tree is yielded once per derivation, so a grammar in 
+    which two derivations make the same tree yields it twice. 
+    Parsing itself is done up front, so a ParsingError is raised here and 
+    not by the iterator; as no tree is built until the iterator is consumed,
+    this is also the way to recognize a sentence (or to collect its stats,
+    which are given as in parse()) without extracting its trees
+    """
+    if isinstance(tokens, str):
+        tokens = tokens.split()
+    tokens = list(tokens)
+    chart, matches, stats = _fill_chart(grammar, start_symbol, tokens, debug, 
+        stats)
+    trees = _iter_trees(chart, matches, tokens)
+    if stats is not None:
+        return trees, stats
     return trees
 
+def _iter_trees(chart, matches, tokens):
+    cache = {}
+    for m in matches:
+        for t in chart.iter_subtrees(m, tokens, cache):
+            yield t
+
+def parse_k_best(grammar, start_symbol, tokens, k, score, debug = False):
+    """
+    Returns a list of the (at most) k distinct parse trees with the highest 
+    scores, best first; score is a function taking a tree and returning a 
+    number. 
+    
+    Note that this is exhaustive: as the score of a tree is arbitrary (it 
+    needn't be made of the scores of its subtrees), nothing can be pruned, 
+    and every tree iter_parse() yields is built and scored; only the memory 
+    is bounded, as only k trees are kept at any time. Its time is therefore 
+    that of enumerating all the trees, which is exponential in the length of
+    an ambiguous sentence; to stop early (e.g., after the first tree), 
+    consume iter_parse() directly
+    """
+    if k <= 0:
+        return []
+    heap = []       # (score, tie breaker, tree), the worst on top
+    kept = set()
+    for n, t in enumerate(iter_parse(grammar, start_symbol, tokens, debug)):
+        if t in kept:
+            continue
+        entry = (score(t), -n, t)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            kept.discard(heapq.heapreplace(heap, entry)[2])
+        else:
+            continue
+        kept.add(t)
+    return [t for _, _, t in sorted(heap, reverse = True)]
 
+
+
+#==============================================================================
+# Parse cache
+#==============================================================================
+class ParseCache(object):
+    """
+    A least-recently-used cache of parse() results, for traffic that repeats 
+    sentences. Results are keyed by the content hash of the grammar, the 
+    start symbol and the tokens; beyond `size` entries, the least recently 
+    used one is evicted. Failures are cached too, and raised again. 
+    
+    The hits, misses and evictions counters tell how well the size fits 
+    the traffic.
+    """
+    def __init__(self, size = 1024):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+    def __len__(self):
+        return len(self._entries)
+    def __repr__(self):
+        return "ParseCache(%s)" % (", ".join("%s=%r" % (k, v) 
+            for k, v in sorted(self.as_dict().items())),)
+    def as_dict(self):
+        """
+        Returns the size, the number of entries and the counters as a plain 
+        dict
+        """
+        return dict(size = self.size, entries = len(self._entries), 
+            hits = self.hits, misses = self.misses, evictions = self.evictions)
+    def clear(self):
+        """
+        Drops all entries (but keeps the counters)
+        """
+        self._entries.clear()
+    
+    def get(self, key):
+        """
+        Returns the entry cached under the given key, which becomes the most
+        recently used one, or None
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = entry
+        return entry
+    def put(self, key, entry):
+        """
+        Caches the given entry under the given key, evicting the least 
+        recently used entries beyond the size
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last = False)
+            self.evictions += 1
+    
+    def parse(self, grammar, start_symbol, tokens):
+        """
+        Returns parse(grammar, start_symbol, tokens), from the cache if it's
+        there; the trees are kept in a frozenset, and every hit gets a set 
+        of its own
+        """
+        key = (grammar.content_hash(), start_symbol, tuple(tokens))
+        entry = self.get(key)
+        if entry is None:
+            try:
+                entry = (frozenset(parse(grammar, start_symbol, tokens)), None)
+            except ParsingError as ex:
+                entry = (None, ex)
+            self.put(key, entry)
+        trees, error = entry
+        if error is not None:
+            raise error
+        return set(trees)
+
+#==============================================================================
+# Parallel parsing
+#
+# The same rules, applied bottom-up, CKY-style: the chart is filled one span 
+# length at a time, and the spans (i, k) of a length depend only on shorter 
+# spans, so they are filled independently of each other, by a pool of worker
+# processes. Instead of being predicted, every tree that may be predicted is 
+# placed at every position. As parse() substitutes a subtree of an elementary
+# tree (by rule (8)) only where it was predicted, by rule (9), the states 
+# parse() would not have made are dropped afterwards, by a pass over the 
+# chart that makes parse()'s predictions (see _prune_chart).
+# 
+# A state of the span (i, k) is either made of two states of the spans 
+# (i, j) and (j, k), for i < j < k, or of a state of the span itself and a 
+# state of the empty span at either of its ends (or of a scanned token, or a 
+# state of the span itself, alone); the worker combines the former pairs up
+# front, and the latter with a local agenda. Workers are forked for every 
+# length, so they inherit the spans filled so far, and only the new states 
+# (and what they were made of) travel back
+#==============================================================================
+class _Span(object):
+    """
+    The states of one span, indexed like the chart indexes them (see
+    Chart.mark_processed): as complete states, to combine with the states of
+    the spans ending where this one starts, and as waiting, adjoinable or 
+    complete states, to combine with the spans starting where it ends
+    """
+    def __init__(self, grammar, states = ()):
+        self.grammar = grammar
+        self.complete = []
+        self.completed = {}
+        self.completed_trees = {}
+        self.completed_roots = {}
+        self.waiting = {}
+        self.adjoinable = {}
+        for st in states:
+            self.add(st)
+    def add(self, st):
+        if st.is_complete():
+            self.complete.append(st)
+            _append(self.completed, (st.tree.root, 
+                self.grammar.get_tree_type(st.tree)), st)
+            _append(self.completed_trees, st.tree, st)
+            _append(self.completed_roots, st.tree.root, st)
+        else:
+            _append(self.waiting, st.next(), st)
+        if st.dot == 0:
+            _append(self.adjoinable, st.tree.root, st)
+
+def _get_seeds(grammar):
+    # (tree, rule) for every tree that may be predicted: the initial trees,
+    # the auxiliary trees, and the subtrees of them all
+    seeds = collections.OrderedDict()
+    for rule, coll in ((7, grammar.init_trees_by_symbol), 
+            (2, grammar.left_aux_trees_by_symbol), 
+            (11, grammar.right_aux_trees_by_symbol)):
+        for trees in coll.values():
+            for t in trees:
+                seeds.setdefault(t, rule)
+    for t in list(seeds):
+        for sub in t.subtrees():
+            seeds.setdefault(sub, 9)
+    return seeds.items()
+
+def _combine(grammar, left, st2, add):
+    # (3), (8), (10) and (12), with st2 as the complete state on the right, 
+    # and the states of the span `left` on the left
+    root = st2.tree.root
+    type = grammar.get_tree_type(st2.tree)
+    if type == Tree.LEFT_AUX:
+        # (3)
+        for st1 in left.adjoinable.get(root, ()):
+            add(State(st1.tree, 0, st1.i, st2.j), 3, BUILD_AUX, st1, st2)
+    elif type == Tree.RIGHT_AUX:
+        # (12)
+        for st1 in left.completed_roots.get(root, ()):
+            add(State(st1.tree, len(st1.tree.children), st1.i, st2.j), 12, 
+                BUILD_AUX, st1, st2)
+    else:
+        # (8)
+        for st1 in left.waiting.get(root, ()):
+            add(State(st1.tree, st1.dot + 1, st1.i, st2.j), 8, 
+                BUILD_SUBSTITUTION, st1, st2)
+    # (10)
+    for st1 in left.waiting.get(st2.tree, ()):
+        add(State(st1.tree, st1.dot + 1, st1.i, st2.j), 10, 
+            BUILD_SUBSTITUTION, st1, st2)
+
+def _combine_right(grammar, st1, right, add):
+    # (3), (8), (10) and (12), with st1 as the state on the left, and the 
+    # complete states of the span `right` on the right
+    if st1.dot == 0:
+        # (3)
+        for st2 in right.completed.get((st1.tree.root, Tree.LEFT_AUX), ()):
+            add(State(st1.tree, 0, st1.i, st2.j), 3, BUILD_AUX, st1, st2)
+    if st1.is_complete():
+        # (12)
+        for st2 in right.completed.get((st1.tree.root, Tree.RIGHT_AUX), ()):
+            add(State(st1.tree, len(st1.tree.children), st1.i, st2.j), 12, 
+                BUILD_AUX, st1, st2)
+        return
+    prod = st1.next()
+    if isinstance(prod, NonTerminal):
+        # (8)
+        for st2 in right.completed.get((prod, Tree.INIT_TREE), ()):
+            add(State(st1.tree, st1.dot + 1, st1.i, st2.j), 8, 
+                BUILD_SUBSTITUTION, st1, st2)
+    elif isinstance(prod, Tree):
+        # (10)
+        for st2 in right.completed_trees.get(prod, ()):
+            add(State(st1.tree, st1.dot + 1, st1.i, st2.j), 10, 
+                BUILD_SUBSTITUTION, st1, st2)
+
+# the grammar, tokens, seeds and filled spans of the length being filled, 
+# set in the workers by _init_layer
+_layer_grammar = None
+_layer_tokens = None
+_layer_seeds = None
+_layer_spans = None
+
+def _init_layer(grammar, tokens, seeds, spans):
+    global _layer_grammar, _layer_tokens, _layer_seeds, _layer_spans
+    _layer_grammar = grammar
+    _layer_tokens = tokens
+    _layer_seeds = seeds
+    _layer_spans = spans
+
+def _fill_span(span):
+    # returns [(state, rule, subtree-builder, states it was made of), ...] 
+    # for every way a state of the given span was made, in the order the 
+    # states were made
+    i, k = span
+    grammar = _layer_grammar
+    results = []
+    seen = set()
+    agenda = collections.deque()
+    def add(st, rule, func = None, *operands):
+        results.append((st, rule, func, operands))
+        if st not in seen:
+            seen.add(st)
+            agenda.append(st)
+    
+    local = _Span(grammar)
+    if i == k:
+        # (1), (2), (7), (9) and (11)
+        for t, rule in _layer_seeds:
+            add(State(t, 0, i, i), rule)
+        before = after = local
+    else:
+        before = _layer_spans[i, i]
+        after = _layer_spans[k, k]
+        # (4)
+        for st in _layer_spans[i, k - 1].waiting.get(_layer_tokens[k - 1], ()):
+            add(State(st.tree, st.dot + 1, i, k), 4, BUILD_PROPAGATE, st)
+        for j in range(i + 1, k):
+            left = _layer_spans[i, j]
+            for st2 in _layer_spans[j, k].complete:
+                _combine(grammar, left, st2, add)
+    
+    while agenda:
+        st = agenda.popleft()
+        prod = st.next()
+        if prod == "" or isinstance(prod, Foot):
+            # (5) and (6)
+            add(State(st.tree, st.dot + 1, i, k), 5 if prod == "" else 6, 
+                BUILD_PROPAGATE, st)
+        # with the states processed so far; on an empty span, `before` and 
+        # `after` are both the local one, so st is added to it in between, 
+        # and its pair with itself is combined (once) by _combine
+        _combine_right(grammar, st, after, add)
+        local.add(st)
+        if st.is_complete():
+            _combine(grammar, before, st, add)
+    return results
+
+def _map_layer(grammar, tokens, seeds, spans, layer, workers):
+    if workers <= 1 or len(layer) < 2:
+        _init_layer(grammar, tokens, seeds, spans)
+        try:
+            return map(_fill_span, layer)
+        finally:
+            _init_layer(None, None, None, None)
+    pool = multiprocessing.Pool(min(workers, len(layer)), _init_layer, 
+        (grammar, tokens, seeds, spans))
+    try:
+        results = pool.map(_fill_span, layer)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def _fill_chart_parallel(grammar, start_symbol, tokens, workers, debug, stats):
+    """
+    The bottom-up counterpart of _fill_chart()
+    """
+    if stats is True:
+        stats = ParseStats()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    grammar = grammar.select(tokens)
+    seeds = _get_seeds(grammar)
+    filled = Chart(grammar)
+    spans = {}
+    for length in range(len(tokens) + 1):
+        layer = [(i, i + length) for i in range(len(tokens) - length + 1)]
+        results = _map_layer(grammar, tokens, seeds, spans, layer, workers)
+        for span, changes in zip(layer, results):
+            first = len(filled)
+            for st, rule, func, operands in changes:
+                filled.add(st, (rule,), func, *operands)
+                filled.commit()
+            spans[span] = _Span(grammar, filled[first:])
+    chart = _prune_chart(grammar, start_symbol, filled, stats, debug)
+    if stats is not None:
+        stats.finish(chart, len(tokens))
+    
+    return chart, _get_matches(grammar, start_symbol, tokens, chart, debug, 
+        stats), stats
+
+def _prune_chart(grammar, start_symbol, filled, stats, debug):
+    """
+    Returns a new chart, of the states and derivations of the filled chart 
+    that parse() makes: starting from the initial trees of the start symbol
+    (1), a state is kept once one of its derivations is made of states that
+    were kept, or, for a tree placed at some position, once the tree is 
+    predicted there (2), (7), (9) and (11) by a state that was kept. The 
+    states are committed in the order they are kept, and every derivation 
+    once it is
+    """
+    chart = Chart(grammar, stats, debug)
+    # filled index -> chart index (or -1), and derivation -> whether it was
+    # committed
+    kept = array.array("i", [-1]) * len(filled)
+    done = array.array("b", [0]) * len(filled._func)
+    # derivation -> the filled index of its state, and filled index -> the 
+    # derivations it is an operand of
+    owners = array.array("i", [-1]) * len(filled._func)
+    uses = {}
+    for index in xrange(len(filled)):
+        d = filled._first[index]
+        while d >= 0:
+            owners[d] = index
+            if filled._func[d] != _BUILD_CONST_CODE:
+                _append(uses, filled._left[d], d)
+                if filled._right[d] not in (-1, filled._left[d]):
+                    _append(uses, filled._right[d], d)
+            d = filled._next[d]
+    predicted = set()
+    pending = collections.deque()
+    
+    def keep(index, st, reason, func = None, *operands):
+        chart.add(st, reason, func, *operands)
+        if chart.commit():
+            kept[index] = len(chart) - 1
+            pending.append(index)
+    
+    def predict(t, j, reason):
+        if (t, j) not in predicted:
+            predicted.add((t, j))
+            st = State(t, 0, j, j)
+            keep(filled.index_of(st), st, reason)
+    
+    # (1)
+    for t in grammar.get_init_trees_for(start_symbol):
+        predict(t, 0, (1,))
+    
+    while pending:
+        index = pending.popleft()
+        st = chart[kept[index]]
+        prod = st.next()
+        if st.dot == 0:
+            # (2)
+            for t in grammar.get_left_aux_trees_for(st.tree.root):
+                predict(t, st.j, (2, st.index))
+        if isinstance(prod, NonTerminal):
+            # (7)
+            for t in grammar.get_init_trees_for(prod):
+                predict(t, st.j, (7, st.index))
+        elif isinstance(prod, Tree):
+            # (9)
+            predict(prod, st.j, (9, st.index))
+        elif st.is_complete():
+            # (11)
+            for t in grammar.get_right_aux_trees_for(st.tree.root):
+                predict(t, st.j, (11, st.index))
+        
+        # the derivations of the other rules, once all their states are kept
+        for d in uses.get(index, ()):
+            left, right = filled._left[d], filled._right[d]
+            if done[d] or kept[left] < 0 or (right >= 0 and kept[right] < 0):
+                continue
+            done[d] = 1
+            operands = [chart[kept[left]]]
+            if right >= 0:
+                operands.append(chart[kept[right]])
+            st2 = filled[owners[d]]
+            func = _BUILDERS[filled._func[d]]
+            reason = (_rule_of(st2, func),) + tuple(o.index for o in operands)
+            keep(owners[d], st2, reason, func, *operands)
+    return chart
+
+def _rule_of(st, func):
+    # the number of the rule that made st with the given subtree-builder, for
+    # the rules that combine states
+    if func is BUILD_AUX:
+        return 3 if st.dot == 0 else 12
+    prod = st.tree.children[st.dot - 1]
+    if func is BUILD_SUBSTITUTION:
+        return 10 if isinstance(prod, Tree) else 8
+    if isinstance(prod, Foot):
+        return 6
+    return 5 if prod == "" else 4
+
+def parse_parallel(grammar, start_symbol, tokens, workers = None, 
+        debug = False, stats = None):
+    """
+    Like parse(), but fills the chart bottom-up, one span length at a time, 
+    with the spans of each length divided among `workers` processes (by 
+    default, one per CPU; with workers <= 1, everything is done in this 
+    process). The chart then holds the states of parse()'s chart (in another
+    order), so the matching states and the trees are the same as parse()'s;
+    the states that parse() doesn't predict, as nothing is predicted 
+    top-down, are made but not kept. Each length costs a fork of the pool, 
+    so this pays off for long sentences (and more than one CPU) only
+    """
+    if isinstance(tokens, str):
+        tokens = tokens.split()
+    tokens = list(tokens)
+    chart, matches, stats = _fill_chart_parallel(grammar, start_symbol, 
+        tokens, workers, debug, stats)
+    return _extract_trees(chart, matches, tokens, stats)
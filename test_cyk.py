@@ -0,0 +1,92 @@
+import numpy
+from earley3 import Rule, Production
+from cyk import CNF, PCFG, parse
+
+#===============================================================================
+# PCFG.marginals() against a brute-force enumeration of the parse trees of the
+# original grammar. The grammar has unit rules (S -> VP, VP -> V, NP -> N),
+# which the CNF conversion eliminates, so their symbols only get the right
+# marginals if the outside pass accounts for the unit chains
+#===============================================================================
+N = Rule("N", Production("boy", prob = 0.5), Production("telescope", prob = 0.5))
+P = Rule("P", Production("with"))
+V = Rule("V", Production("saw"))
+NP = Rule("NP", Production("john", prob = 0.5), Production(N, prob = 0.3))
+PP = Rule("PP", Production(P, NP))
+NP.add(Production(NP, PP, prob = 0.2))
+VP = Rule("VP", Production(V, NP, prob = 0.5), Production(V, prob = 0.2))
+VP.add(Production(VP, PP, prob = 0.3))
+S = Rule("S", Production(NP, VP, prob = 0.8), Production(VP, prob = 0.2))
+
+def derivations(term, tokens, i, j):
+    # yields (probability, [(rule name, start, end), ...]) for every way term
+    # derives tokens[i:j]
+    if isinstance(term, basestring):
+        if j == i + 1 and tokens[i] == term:
+            yield 1.0, []
+        return
+    for prod in term.productions:
+        for prob, nodes in sequences(prod.terms, tokens, i, j):
+            yield prod.prob * prob, [(term.name, i, j)] + nodes
+
+def sequences(terms, tokens, i, j):
+    if not terms:
+        if i == j:
+            yield 1.0, []
+        return
+    for k in range(i + 1, j - len(terms) + 2):
+        for prob, nodes in derivations(terms[0], tokens, i, k):
+            for prob2, nodes2 in sequences(terms[1:], tokens, k, j):
+                yield prob * prob2, nodes + nodes2
+
+def brute_force_marginals(rule, tokens):
+    total = 0.0
+    spans = {}
+    for prob, nodes in derivations(rule, tokens, 0, len(tokens)):
+        total += prob
+        for node in set(nodes):
+            spans[node] = spans.get(node, 0.0) + prob
+    return total, dict((node, prob / total) for node, prob in spans.items())
+
+#===============================================================================
+# DEL turns S -> S OPT, with OPT nullable, into the unit loop S -> S, which UNIT
+# drops. Every S may take it any number of times, so the inside probability
+# of S is that of its loop-free derivations over 1 - 0.4 * 0.5, and S has
+# infinitely many derivations to count
+#===============================================================================
+OPT = Rule("OPT", Production(prob = 0.5), Production("b", prob = 0.5))
+LOOP = Rule("LOOP", Production("a", prob = 0.6))
+LOOP.add(Production(LOOP, OPT, prob = 0.4))
+
+if __name__ == "__main__":
+    cnf = CNF(LOOP)
+    chart = parse(cnf, "a b b")
+    assert [tree.bracketed() for tree in chart] == ["(LOOP (LOOP (LOOP a) (OPT b)) (OPT b))"]
+    try:
+        chart.count()
+    except ValueError:
+        pass
+    else:
+        assert False, "counted the derivations of a unit loop"
+    pcfg = PCFG(cnf)
+    assert numpy.isclose(pcfg.inside(["a"])[0, 1, cnf.start], 0.6 / 0.8)
+    assert numpy.isclose(pcfg.inside(["a", "b"])[0, 2, cnf.start], 0.4 * 0.6 * 0.5 / 0.8 ** 2)
+    assert numpy.isclose(pcfg.viterbi(["a", "b"])[0], 0.4 * 0.6 * 0.5)
+    assert numpy.isclose(pcfg.marginals(["a", "b"])[0, 1, cnf.names.index("LOOP")], 1.0)
+
+    pcfg = PCFG(S)
+    names = pcfg.cnf.names
+    for text in ["saw", "saw john", "john saw", "john saw boy with telescope",
+            "saw boy with telescope with john"]:
+        tokens = text.split()
+        total, expected = brute_force_marginals(S, tokens)
+        assert numpy.isclose(pcfg.inside(tokens)[0, len(tokens), pcfg.cnf.start], total), text
+        marginals = pcfg.marginals(tokens)
+        for rule in (S, NP, VP, PP, N, P, V):
+            a = names.index(rule.name)
+            for i in range(len(tokens)):
+                for j in range(i + 1, len(tokens) + 1):
+                    assert numpy.isclose(marginals[i, j, a], expected.get((rule.name, i, j), 0.0)), (
+                        text, rule.name, i, j, marginals[i, j, a], expected.get((rule.name, i, j)))
+        print "%-40s | inside %.6f" % (text, total)
+    print "Hooray!"
@@ -1,3 +1,6 @@
+import numpy
+
+
 class State(object):
     def __init__(self, name):
         self.name = name
@@ -29,6 +32,34 @@ class HMM(object):
         return (self.states[k] for k in range(1, self.num_of_internal_states+1))
     def all_states(self):
         return (self.states[k] for k in range(0, self.num_of_internal_states+2))
+    def compile(self):
+        return CompiledHMM(self)
+
+class CompiledHMM(object):
+    # the HMM as log-probability matrices over its internal states (q1..qN 
+    # are rows/columns 0..N-1): start[s] = log a(q0, s), final[q] = log a(q, qF),
+    # trans[q, s] = log a(q, s) and emit[s, k] = log b(s, symbols[k]). 
+    # emit has an extra column of -inf for symbols no state emits
+    def __init__(self, hmm):
+        self.states = list(hmm.internal_states())
+        self.symbols = sorted(set(ch for s in self.states for ch in s.b_table))
+        self.symbol_index = dict((ch, k) for k, ch in enumerate(self.symbols))
+        self.q0 = hmm.q0
+        self.qF = hmm.qF
+        trans = [[q.get_a(s) for s in self.states] for q in self.states]
+        emit = numpy.zeros((len(self.states), len(self.symbols) + 1))
+        for i, s in enumerate(self.states):
+            for ch, prob in s.b_table.items():
+                emit[i, self.symbol_index[ch]] = prob
+        with numpy.errstate(divide = "ignore"):
+            self.start = numpy.log([self.q0.get_a(s) for s in self.states])
+            self.final = numpy.log([q.get_a(self.qF) for q in self.states])
+            self.trans = numpy.log(trans)
+            self.emit = numpy.log(emit)
+    def encode(self, observations):
+        unknown = len(self.symbols)
+        return numpy.array([self.symbol_index.get(ch, unknown) for ch in observations], 
+            dtype = numpy.intp)
 
 class TableCell(object):
     def __init__(self):
@@ -53,7 +84,7 @@ class Table(object):
         s, t = ind
         return self.cells[s][t]
 
-def viterbi(hmm, observations):
+def viterbi_table(hmm, observations):
     table = Table(hmm, observations)
     
     for s in hmm.internal_states():
@@ -91,6 +122,32 @@ def viterbi(hmm, observations):
     path.append(s)
     path.append(hmm.q0)
     return path[::-1]
+
+def viterbi(hmm, observations):
+    # the same recursion as viterbi_table, in log space: one max/argmax over 
+    # the (previous state, state) matrix per observation, with the back 
+    # pointers kept in an int array. hmm may be an HMM or a CompiledHMM; 
+    # compile it once when decoding many sequences
+    if not isinstance(hmm, CompiledHMM):
+        hmm = hmm.compile()
+    obs = hmm.encode(observations)
+    n = len(hmm.states)
+    back = numpy.zeros((len(obs), n), dtype = numpy.intp)
+    columns = numpy.arange(n)
+    delta = hmm.start + hmm.emit[:, obs[0]]
+    for t in range(1, len(obs)):
+        scores = delta[:, numpy.newaxis] + hmm.trans
+        back[t] = scores.argmax(axis = 0)
+        delta = scores[back[t], columns] + hmm.emit[:, obs[t]]
+    
+    s = int((delta + hmm.final).argmax())
+    path = [hmm.qF]
+    for t in range(len(obs) - 1, 0, -1):
+        path.append(hmm.states[s])
+        s = back[t, s]
+    path.append(hmm.states[s])
+    path.append(hmm.q0)
+    return path[::-1]
     
     
 
@@ -115,6 +172,7 @@ if __name__ == "__main__":
     
     #print viterbi(h, "vvuvuu")
     #print viterbi(h, "uuuvuuv")
+    print viterbi_table(h, "u")
     print viterbi(h, "u")
 
 